@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Shared helpers for benchmarks. """
+
+import os
+import sys
+import timeit
+
+# Make sure url_sso can be imported when running from a checkout
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+# Test data shipped with the plugin tests
+data_directory = os.path.join(
+    os.path.dirname(__file__), '..', 'url_sso', 'tests', 'data'
+)
+
+
+def load_test_data(filename):
+    """ Return contents of a file from the test data directory. """
+
+    return open(os.path.join(data_directory, filename)).read()
+
+
+def setup_django(**extra_settings):
+    """ Configure Django with minimal settings for benchmarking. """
+
+    from django.conf import settings
+
+    benchmark_settings = {
+        'DATABASES': {
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3'
+            }
+        },
+        'INSTALLED_APPS': [
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'url_sso'
+        ],
+        'SECRET_KEY': 'benchmark',
+    }
+    benchmark_settings.update(extra_settings)
+
+    settings.configure(**benchmark_settings)
+
+
+def benchmark(name, func, number=10000, repeat=3):
+    """
+    Time `func`, printing and returning the best time per call in
+    microseconds.
+    """
+
+    timer = timeit.Timer(func)
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    usec = best * 1000000
+    print '%-40s %10.2f usec/call' % (name, usec)
+
+    return usec
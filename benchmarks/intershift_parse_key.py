@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark extracting Intershift login keys from (broken) XML responses.
+
+Usage: python benchmarks/intershift_parse_key.py
+"""
+
+from lxml import etree
+
+from common import setup_django, benchmark, load_test_data
+
+setup_django()
+
+from url_sso.plugins.intershift import intershift_plugin
+
+fixtures = (
+    'intershift_key_response.xml',
+    'intershift_key_response_broken.xml'
+)
+
+
+def parse_tree(data):
+    """ Previous approach: new recovering parser and a full tree. """
+
+    parser = etree.XMLParser(recover=True)
+    root = etree.fromstring(data, parser)
+
+    return root.find('key').get('value')
+
+
+def main():
+    for filename in fixtures:
+        data = load_test_data(filename)
+
+        print filename
+
+        tree = benchmark(
+            '  New parser, full tree', lambda: parse_tree(data)
+        )
+
+        # Force the fallback path with a reused parser
+        fallback = benchmark(
+            '  Reused parser, full tree',
+            lambda: etree.fromstring(
+                data, intershift_plugin._get_parser()
+            ).find('key').get('value')
+        )
+
+        fast = benchmark(
+            '  _parse_login_key()',
+            lambda: intershift_plugin._parse_login_key(data)
+        )
+
+        print '  Speedup: %.1fx (reused parser: %.1fx)' % (
+            tree / fast, tree / fallback
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark iProva token requests with and without reusing the SOAP client.
+
+Usage: python benchmarks/iprova_client.py
+"""
+
+from httmock import HTTMock
+
+from common import setup_django, benchmark, load_test_data
+
+setup_django(URL_SSO_IPROVA={
+    'root_url': 'http://intranet.organisation.com/',
+    'services': ('management', 'idocument', 'iportal', 'itask'),
+    'key_expiration': 3600,
+    'application_id': 'SharepointIntranet_Production'
+})
+
+from url_sso.plugins.iprova import iprova_plugin
+
+test_wsdl = load_test_data('iprova_usermanagement_wsdl.xml')
+
+test_response = load_test_data('iprova_token_response.xml').format(
+    token='3f5c99f7d8214862afa8c27826b78e14'
+)
+
+
+def soap_mock(url, request):
+    """ Serve WSDL for GET requests and a token for SOAP calls. """
+
+    if request.method == 'GET':
+        return test_wsdl
+
+    return test_response
+
+
+def request_token_new_client():
+    """ Request token, creating a new SOAP client (WSDL from cache). """
+
+    iprova_plugin._reset_client()
+    iprova_plugin._request_token('john')
+
+
+def request_token_reused_client():
+    """ Request token, reusing the SOAP client. """
+
+    iprova_plugin._request_token('john')
+
+
+def main():
+    with HTTMock(soap_mock):
+        # Warm the WSDL cache
+        iprova_plugin._request_token('john')
+
+        new_client = benchmark(
+            'Token request, new client', request_token_new_client,
+            number=200
+        )
+        reused_client = benchmark(
+            'Token request, reused client', request_token_reused_client,
+            number=200
+        )
+
+    print 'Saving per token request: %.2f usec' % (
+        new_client - reused_client
+    )
+
+
+if __name__ == '__main__':
+    main()
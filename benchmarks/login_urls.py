@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark rendering login URL's through the `login_urls` context processor,
+with simulated backend latency and cold, warm or mixed caches.
+
+Reports per-render latency percentiles and backend calls per render, which
+can be saved as a baseline and compared against later runs.
+
+Usage: python benchmarks/login_urls.py [options]
+
+Examples::
+
+    # Default scenarios, compared against the stored baseline
+    python benchmarks/login_urls.py --compare benchmarks/login_urls_baseline.json
+
+    # Ten Intershift sites, requesting keys concurrently
+    python benchmarks/login_urls.py --sites 10 --max-workers 4
+"""
+
+import os
+import json
+import random
+import threading
+import time
+
+from optparse import OptionParser
+
+from common import setup_django
+
+option_parser = OptionParser(usage='%prog [options]')
+option_parser.add_option(
+    '--plugins', default='intershift,iprova',
+    help='Comma separated plugins to enable (default: %default)'
+)
+option_parser.add_option(
+    '--sites', type='int', default=3,
+    help='Number of Intershift sites (default: %default)'
+)
+option_parser.add_option(
+    '--services', type='int', default=4,
+    help='Number of iProva services (default: %default)'
+)
+option_parser.add_option(
+    '--latency', type='float', default=20,
+    help='Simulated backend latency in milliseconds (default: %default)'
+)
+option_parser.add_option(
+    '--renders', type='int', default=50,
+    help='Number of renders per cache state (default: %default)'
+)
+option_parser.add_option(
+    '--cache', action='append', choices=['cold', 'warm', 'mixed'],
+    help='Cache state to benchmark, may be repeated (default: all)'
+)
+option_parser.add_option(
+    '--max-workers', type='int', default=1,
+    help='Threads requesting Intershift keys (default: %default)'
+)
+option_parser.add_option(
+    '--concurrent', action='store_true', default=False,
+    help='Call plugins concurrently (URL_SSO_CONCURRENT)'
+)
+option_parser.add_option(
+    '--fast-soap', action='store_true', default=False,
+    help='Use the fast SOAP path for iProva'
+)
+option_parser.add_option(
+    '--save', metavar='FILE',
+    help='Save results as a baseline to FILE'
+)
+option_parser.add_option(
+    '--compare', metavar='FILE',
+    help='Compare results against the baseline in FILE'
+)
+
+options, args = option_parser.parse_args()
+
+plugin_names = [name for name in options.plugins.split(',') if name]
+
+intershift_settings = {
+    'secret': '12345678',
+    'sites': dict(
+        ('site%d' % index, {
+            'url': 'https://customer1.intershift.nl/site%d/cust/'
+                   'singlesignon.asp' % index
+        }) for index in range(options.sites)
+    ),
+    'key_expiration': 86400,
+    'max_workers': options.max_workers
+}
+
+iprova_settings = {
+    'root_url': 'http://intranet.organisation.com/',
+    'services': ['service%d' % index for index in range(options.services)],
+    'key_expiration': 3600,
+    'application_id': 'SharepointIntranet_Production',
+    'fast_soap': options.fast_soap
+}
+
+setup_django(
+    URL_SSO_PLUGINS=[
+        'url_sso.plugins.{0}.{0}_plugin'.format(name) for name in plugin_names
+    ],
+    URL_SSO_INTERSHIFT=intershift_settings,
+    URL_SSO_IPROVA=iprova_settings,
+    URL_SSO_CONCURRENT=options.concurrent,
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+        }
+    }
+)
+
+from httmock import HTTMock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test.client import RequestFactory
+
+from url_sso.context_processors import login_urls
+from url_sso.settings import url_sso_settings
+
+from common import load_test_data
+
+test_key_response = load_test_data('intershift_key_response.xml')
+test_wsdl = load_test_data('iprova_usermanagement_wsdl.xml')
+test_token_response = load_test_data('iprova_token_response.xml').format(
+    token='3f5c99f7d8214862afa8c27826b78e14'
+)
+
+
+class Backend(object):
+    """ Stand-in for the Intershift and iProva backends. """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+        self._lock = threading.Lock()
+
+    def __call__(self, url, request):
+        if 'intershift' in url.netloc:
+            response = test_key_response
+
+        elif request.method == 'GET':
+            # Fetching the WSDL happens once and is not counted
+            return test_wsdl
+
+        else:
+            response = test_token_response
+
+        with self._lock:
+            self.calls += 1
+
+        time.sleep(self.latency)
+
+        return response
+
+
+def percentile(values, percent):
+    """ Return `percent` percentile of sorted `values`. """
+
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+
+    return values[index]
+
+
+def render(request):
+    """ Resolve all login URL's, like a template listing them would. """
+
+    return dict(login_urls(request))
+
+
+def get_cache_keys(username):
+    """ Return cache keys for the login URL's of a user. """
+
+    cache_keys = []
+
+    for sso_plugin in url_sso_settings.PLUGINS:
+        cache_keys.extend(sso_plugin.get_user_cache_keys(username))
+
+    return cache_keys
+
+
+def run_scenario(cache_state, backend, request):
+    """
+    Render `options.renders` times with the cache in `cache_state`,
+    returning a dict with results.
+    """
+
+    cache_keys = get_cache_keys(request.user.username)
+
+    # Deterministic choice of keys to drop for a mixed cache
+    rand = random.Random(0)
+
+    # Fill the cache (and create SOAP clients) before measuring
+    render(request)
+
+    timings = []
+    calls = 0
+
+    for index in range(options.renders):
+        if cache_state == 'cold':
+            cache.delete_many(cache_keys)
+
+        elif cache_state == 'mixed':
+            cache.delete_many(
+                rand.sample(cache_keys, (len(cache_keys) + 1) // 2)
+            )
+
+        calls_before = backend.calls
+        start = time.time()
+
+        render(request)
+
+        timings.append((time.time() - start) * 1000)
+        calls += backend.calls - calls_before
+
+    timings.sort()
+
+    return {
+        'mean': sum(timings) / len(timings),
+        'p50': percentile(timings, 50),
+        'p90': percentile(timings, 90),
+        'p99': percentile(timings, 99),
+        'max': timings[-1],
+        'calls': float(calls) / options.renders
+    }
+
+
+def print_results(name, results, baseline=None):
+    """ Print results, with the relative change from `baseline`. """
+
+    line = '%-6s' % name
+
+    for metric in ('mean', 'p50', 'p90', 'p99', 'max', 'calls'):
+        line += ' %5s %8.2f' % (metric, results[metric])
+
+        if baseline and baseline.get(metric):
+            change = (results[metric] / baseline[metric] - 1) * 100
+            line += ' (%+4.0f%%)' % change
+
+    print line
+
+
+def main():
+    request = RequestFactory().get('/')
+    request.user = User(username='john')
+
+    backend = Backend(options.latency / 1000.0)
+
+    baseline = {}
+    if options.compare:
+        baseline = json.load(open(options.compare))
+
+    print 'Plugins: %s, sites: %d, services: %d, latency: %.0f ms' % (
+        ', '.join(plugin_names), options.sites, options.services,
+        options.latency
+    )
+    print 'Latency in ms per render, backend calls per render'
+
+    results = {}
+
+    with HTTMock(backend):
+        for cache_state in options.cache or ['cold', 'warm', 'mixed']:
+            results[cache_state] = run_scenario(cache_state, backend, request)
+
+            print_results(
+                cache_state, results[cache_state], baseline.get(cache_state)
+            )
+
+    if options.save:
+        json.dump(results, open(options.save, 'w'), indent=4, sort_keys=True)
+
+        print 'Baseline saved to %s' % os.path.abspath(options.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark resolving URL_SSO_PLUGINS per render versus using the cached
+plugin registry.
+
+Usage: python benchmarks/plugin_registry.py
+"""
+
+from common import setup_django, benchmark
+
+setup_django(URL_SSO_PLUGINS=[
+    'url_sso.plugins.intershift.intershift_plugin',
+    'url_sso.plugins.iprova.iprova_plugin'
+])
+
+from url_sso.settings import url_sso_settings
+
+
+def main():
+    uncached = benchmark(
+        'Import plugins on every render', url_sso_settings._import_plugins
+    )
+    cached = benchmark(
+        'Cached plugin registry', lambda: url_sso_settings.PLUGINS
+    )
+
+    print 'Saving per render: %.2f usec' % (uncached - cached)
+
+
+if __name__ == '__main__':
+    main()
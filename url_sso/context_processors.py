@@ -20,35 +20,299 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import time
+
+from collections import Mapping
+from multiprocessing import TimeoutError
+
+from django.core.urlresolvers import reverse, NoReverseMatch
+
 from .settings import url_sso_settings
 from .exceptions import RequestKeyException
+from .utils import get_thread_pool, submit_call, use_deadline
+from .metrics import (
+    timed, increment, get_plugin_tag, get_server_timings,
+    collect_server_timings
+)
 
 
-def login_urls(request):
+def get_plugin_login_urls(sso_plugin, request):
     """
-    Make sure SSO login URL's are available in the template context.
+    Return login URL's for a single plugin, logging and swallowing
+    RequestKeyException such that a failing backend does not break
+    rendering.
     """
 
-    login_urls = {}
-    for sso_plugin in url_sso_settings.PLUGINS:
-        assert hasattr(sso_plugin, 'get_login_urls'), \
-            'No get_login_urls in SSO plugin.'
+    assert hasattr(sso_plugin, 'get_login_urls'), \
+        'No get_login_urls in SSO plugin.'
+
+    plugin_tag = get_plugin_tag(sso_plugin)
 
+    with timed('login_urls', plugin=plugin_tag):
         try:
-            new_login_urls = sso_plugin.get_login_urls(request)
+            return sso_plugin.get_login_urls(request)
         except RequestKeyException:
             # Log the stack trace but don't make the context processor fail
             logger.exception(
                 'Error requesting login key for %s', sso_plugin
             )
 
-            # Continue to next SSO plugin
-            continue
+            increment('login_urls.errors', plugin=plugin_tag)
+
+            return {}
+
+
+def get_plugin_redirect_urls(sso_plugin, request):
+    """
+    Return local URL's redirecting to the login URL's of a single plugin,
+    such that keys are only requested when a link is followed. Returns None
+    when the plugin does not support single login URL's, or when no redirect
+    URL can be reversed for one of its names.
+    """
+
+    login_url_names = sso_plugin.get_login_url_names(request)
+
+    if login_url_names is None:
+        return None
+
+    plugin_name = sso_plugin.settings_name.lower()
+
+    try:
+        return dict(
+            (key, reverse('url_sso_login_redirect', kwargs={
+                'plugin_name': plugin_name, 'name': name
+            })) for key, name in login_url_names.iteritems()
+        )
+    except NoReverseMatch:
+        # Fall back to direct login URL's
+        logger.exception(
+            'No redirect URL for login URL\'s of %s', sso_plugin
+        )
+
+        return None
+
+
+class LazyLoginURLs(Mapping):
+    """
+    Read-only mapping of login URL's which only calls plugins once a key
+    is actually looked up.
+
+    Plugins advertising their context keys through `get_login_url_keys()`
+    are resolved individually, so looking up `INTERSHIFT_FOO_SSO_URL` never
+    touches iProva. Plugins which do not advertise their keys are resolved
+    as soon as an unknown key is requested. Iteration, `len()` and
+    comparison resolve all plugins.
+
+    When `URL_SSO_CONCURRENT` is set, resolving all plugins calls them in
+    parallel, dropping plugins not finished within `URL_SSO_DEADLINE`.
 
-        assert not filter(lambda x: x in login_urls, new_login_urls), \
+    With `URL_SSO_BUDGET` set, all backend calls made for the request share
+    a latency budget starting when the mapping is created.
+
+    With `URL_SSO_CONTEXT_MODE` set to 'redirect', plugins supporting single
+    login URL's provide local redirect URL's instead, without contacting
+    their backends.
+    """
+
+    def __init__(self, request, plugins):
+        self.request = request
+
+        # Server-Timing durations collected for the request, if any
+        self.server_timings = get_server_timings()
+
+        self.redirect = url_sso_settings.CONTEXT_MODE == 'redirect'
+
+        # Deadline for all backend calls for this request
+        budget = url_sso_settings.BUDGET
+        if budget is not None:
+            self.deadline = time.time() + budget
+        else:
+            self.deadline = None
+
+        # Plugins yet to be resolved
+        self._pending = list(plugins)
+
+        # Resolved URL's
+        self._login_urls = {}
+
+        # Map of advertised context keys to their plugin
+        self._key_plugins = {}
+
+        # Plugins which do not advertise their keys
+        self._unadvertised = []
+
+        for sso_plugin in self._pending:
+            keys = sso_plugin.get_login_url_keys()
+
+            if keys is None:
+                self._unadvertised.append(sso_plugin)
+                continue
+
+            for key in keys:
+                assert key not in self._key_plugins, \
+                    'Login URL already present.'
+
+                self._key_plugins[key] = sso_plugin
+
+    def _add_login_urls(self, new_login_urls):
+        """ Store login URL's returned by a plugin. """
+
+        assert not filter(lambda x: x in self._login_urls, new_login_urls), \
             'Login URL already present.'
 
         # Add new URL's
-        login_urls.update(new_login_urls)
+        self._login_urls.update(new_login_urls)
+
+    def _get_plugin_login_urls(self, sso_plugin):
+        """
+        Return login URL's for a single plugin, sharing the deadline and
+        collected timings of the request (also from pool threads).
+        """
+
+        if self.redirect:
+            redirect_urls = get_plugin_redirect_urls(sso_plugin, self.request)
+
+            if redirect_urls is not None:
+                return redirect_urls
+
+        with use_deadline(self.deadline):
+            with collect_server_timings(self.server_timings):
+                return get_plugin_login_urls(sso_plugin, self.request)
+
+    def _resolve(self, sso_plugin):
+        """ Call a single plugin and store its login URL's. """
+
+        self._pending.remove(sso_plugin)
+
+        self._add_login_urls(self._get_plugin_login_urls(sso_plugin))
+
+    def _resolve_concurrently(self, sso_plugins):
+        """
+        Call plugins in parallel and store their login URL's, skipping
+        plugins which do not finish before the deadline.
+
+        The pool is shared by all requests in the process. Plugins which no
+        pool thread has started by the time their result is needed are
+        called from the current thread, limiting backend calls by the
+        deadline. Their result is left out as well when they finish after
+        the deadline.
+        """
+
+        pool = get_thread_pool('plugins', url_sso_settings.MAX_WORKERS)
+
+        deadline = url_sso_settings.DEADLINE
+        if deadline is not None:
+            deadline += time.time()
+
+        calls = []
+        for sso_plugin in sso_plugins:
+            self._pending.remove(sso_plugin)
+
+            calls.append((sso_plugin, submit_call(
+                pool, self._get_plugin_login_urls, sso_plugin
+            )))
+
+        for sso_plugin, call in calls:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(deadline - time.time(), 0)
+
+            if timeout is None or timeout > 0:
+                # Backend calls from this thread are limited by the deadline
+                with use_deadline(deadline):
+                    call.run_here()
+            else:
+                # Don't start plugins past the deadline
+                call.claim()
+
+            try:
+                new_login_urls = call.get(timeout)
+
+                missed = deadline is not None and call.finished > deadline
+            except TimeoutError:
+                missed = True
+
+            if missed:
+                # Log but don't make the context processor fail
+                logger.error(
+                    'Deadline exceeded requesting login key for %s',
+                    sso_plugin
+                )
+
+                # Continue to next SSO plugin
+                continue
+
+            self._add_login_urls(new_login_urls)
+
+    def _resolve_key(self, key):
+        """ Resolve the plugin(s) which might provide `key`. """
+
+        sso_plugin = self._key_plugins.get(key)
+
+        if sso_plugin:
+            if sso_plugin in self._pending:
+                self._resolve(sso_plugin)
+
+        else:
+            # Unknown key; resolve plugins not advertising their keys
+            for sso_plugin in self._unadvertised:
+                if sso_plugin in self._pending:
+                    self._resolve(sso_plugin)
+
+    def _resolve_all(self):
+        """ Resolve all pending plugins. """
+
+        if url_sso_settings.CONCURRENT and len(self._pending) > 1:
+            self._resolve_concurrently(list(self._pending))
+
+        for sso_plugin in list(self._pending):
+            self._resolve(sso_plugin)
+
+    def __getitem__(self, key):
+        if key not in self._login_urls:
+            self._resolve_key(key)
+
+        return self._login_urls[key]
+
+    def __contains__(self, key):
+        if key not in self._login_urls:
+            self._resolve_key(key)
+
+        return key in self._login_urls
+
+    def __iter__(self):
+        self._resolve_all()
+
+        return iter(self._login_urls)
+
+    def __len__(self):
+        self._resolve_all()
+
+        return len(self._login_urls)
+
+    def __repr__(self):
+        return '<%s: %r>' % (self.__class__.__name__, dict(self))
+
+
+def login_urls(request):
+    """
+    Make sure SSO login URL's are available in the template context.
+
+    URL's are resolved lazily, such that backends are only contacted when
+    a template actually uses their login URL's.
+
+    With `URL_SSO_CONTEXT_MODE` set to 'deferred', only the URL of the JSON
+    endpoint providing the login URL's is available, as
+    `SSO_LOGIN_URLS_ENDPOINT`. Login URL's are provided directly when the
+    endpoint can't be reversed.
+    """
+
+    if url_sso_settings.CONTEXT_MODE == 'deferred':
+        try:
+            return {'SSO_LOGIN_URLS_ENDPOINT': reverse('url_sso_login_urls')}
+        except NoReverseMatch:
+            # Fall back to login URL's, i.e. url_sso.urls is not included
+            logger.exception('No URL for the login URL\'s endpoint')
 
-    return login_urls
+    return LazyLoginURLs(request, url_sso_settings.PLUGINS)
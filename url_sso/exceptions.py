@@ -25,3 +25,18 @@ class SSOException(Exception):
 class RequestKeyException(SSOException):
     """ Exceptions generated while requesting keys from remote application. """
     pass
+
+
+class InvalidResponseException(RequestKeyException):
+    """ The remote application returned an error or unparseable response. """
+    pass
+
+
+class CircuitOpenException(RequestKeyException):
+    """ Requests to a backend are refused as its circuit breaker is open. """
+    pass
+
+
+class BudgetExhaustedException(RequestKeyException):
+    """ No time is left in the latency budget for the current request. """
+    pass
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sys
+import time
+
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpRequest
+
+try:
+    from django.contrib.auth import get_user_model
+except ImportError:
+    # Django < 1.5
+    from django.contrib.auth.models import User
+    get_user_model = lambda: User
+
+from url_sso.settings import url_sso_settings
+from url_sso.utils import (
+    BackendRateLimiter, call_in_thread, use_rate_limiter
+)
+
+
+class Command(BaseCommand):
+    args = '[username username ...]'
+    help = (
+        'Mint login URL\'s for users, populating the cache. Usernames are '
+        'read from the arguments, from stdin when none are given (or when '
+        'given "-"), or selected with --filter.'
+    )
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--filter', action='append', dest='filters', default=[],
+            help='Select users by field lookup, e.g. is_active=True. '
+                 'May be given multiple times.'
+        ),
+        make_option(
+            '--workers', action='store', dest='workers', type='int',
+            default=4, help='Number of users to prewarm concurrently.'
+        ),
+        make_option(
+            '--rate', action='store', dest='rate', type='float',
+            default=None, help='Maximum number of requests per second to '
+                               'each backend (default: unlimited).'
+        ),
+        make_option(
+            '--progress', action='store', dest='progress', type='int',
+            default=100, help='Report progress every PROGRESS users.'
+        ),
+    )
+
+    # Number of usernames to look up per query
+    chunk_size = 500
+
+    def get_usernames(self, usernames):
+        """ Return usernames from arguments or stdin. """
+
+        if not usernames or list(usernames) == ['-']:
+            usernames = sys.stdin
+
+        for username in usernames:
+            username = username.strip()
+
+            if username:
+                yield username
+
+    def get_users(self, usernames, filters):
+        """ Return a list of users selected by usernames or filters. """
+
+        UserModel = get_user_model()
+        queryset = UserModel._default_manager.all()
+
+        if filters:
+            lookups = {}
+
+            for lookup in filters:
+                if '=' not in lookup:
+                    raise CommandError(
+                        'Invalid filter %r, use field=value.' % lookup
+                    )
+
+                field, value = lookup.split('=', 1)
+                lookups[field] = value
+
+            return list(queryset.filter(**lookups))
+
+        username_field = getattr(UserModel, 'USERNAME_FIELD', 'username')
+
+        usernames = list(self.get_usernames(usernames))
+
+        users = []
+        for offset in range(0, len(usernames), self.chunk_size):
+            chunk = usernames[offset:offset + self.chunk_size]
+
+            users.extend(queryset.filter(
+                **{'%s__in' % username_field: chunk}
+            ))
+
+        # Report unknown users
+        found = set(getattr(user, username_field) for user in users)
+        for username in usernames:
+            if username not in found:
+                self.stderr.write('Unknown user: %s\n' % username)
+
+        return users
+
+    def prewarm_user(self, user):
+        """
+        Mint login URL's for user with all plugins, returning the number of
+        login URL's failing.
+        """
+
+        request = HttpRequest()
+        request.user = user
+
+        errors = 0
+
+        with use_rate_limiter(self.rate_limiter):
+            for sso_plugin in self.plugins:
+                for e in sso_plugin.prewarm(request):
+                    logger.error(
+                        'Error requesting login key for %s with %s: %s',
+                        user, sso_plugin, e
+                    )
+
+                    errors += 1
+
+        return errors
+
+    def report(self, users, errors, start):
+        """ Write throughput and error counts. """
+
+        duration = time.time() - start
+
+        self.stdout.write(
+            'Prewarmed %d users in %.1fs (%.1f users/s), %d errors\n' % (
+                users, duration, users / duration if duration else 0, errors
+            )
+        )
+
+    def handle(self, *usernames, **options):
+        self.plugins = url_sso_settings.PLUGINS
+
+        if not self.plugins:
+            raise CommandError('No plugins configured in URL_SSO_PLUGINS.')
+
+        if options['rate']:
+            self.rate_limiter = BackendRateLimiter(options['rate'])
+        else:
+            self.rate_limiter = None
+
+        # Users are selected from the main thread, sharing its connection
+        users = self.get_users(usernames, options['filters'])
+
+        pool = ThreadPool(options['workers'])
+
+        start = time.time()
+        count = 0
+        errors = 0
+
+        try:
+            results = pool.imap_unordered(
+                lambda user: call_in_thread(self.prewarm_user, user), users
+            )
+
+            for user_errors in results:
+                count += 1
+                errors += user_errors
+
+                if count % options['progress'] == 0:
+                    self.report(count, errors, start)
+
+        finally:
+            pool.close()
+            pool.join()
+
+        self.report(count, errors, start)
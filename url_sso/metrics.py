@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Instrumentation of the SSO request path.
+
+Timings (in milliseconds) and counts are sent to the sink configured with
+URL_SSO_METRICS_SINK. Metrics are tagged with the plugin and, where
+applicable, the site or service. With the default `NullSink`, metrics are
+not collected at all.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+from .settings import url_sso_settings
+
+
+# Tags added to metrics emitted by the current thread and timings collected
+# for the current request
+_local = threading.local()
+
+
+class MetricsSink(object):
+    """ Base class for metrics sinks. """
+
+    # Whether metrics should be collected for this sink
+    enabled = True
+
+    def timing(self, name, value, tags):
+        """ Record a duration of `value` milliseconds. """
+        raise NotImplementedError
+
+    def increment(self, name, value, tags):
+        """ Increment counter `name` by `value`. """
+        raise NotImplementedError
+
+
+class NullSink(MetricsSink):
+    """ Sink discarding all metrics, such that none are collected. """
+
+    enabled = False
+
+    def timing(self, name, value, tags):
+        pass
+
+    def increment(self, name, value, tags):
+        pass
+
+
+class LoggingSink(MetricsSink):
+    """ Sink writing metrics to the `url_sso.metrics` logger. """
+
+    def _format_tags(self, tags):
+        return ' '.join(
+            '{0}={1}'.format(tag, value)
+            for tag, value in sorted(tags.iteritems())
+        )
+
+    def timing(self, name, value, tags):
+        logger.info('%s %.2fms %s', name, value, self._format_tags(tags))
+
+    def increment(self, name, value, tags):
+        logger.info('%s +%d %s', name, value, self._format_tags(tags))
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sink sending metrics to statsd over UDP, tagged in the DogStatsD format,
+    e.g. `url_sso.backend:42.00|ms|#plugin:intershift,site:portal`.
+
+    The server is configured with URL_SSO_STATSD_HOST and URL_SSO_STATSD_PORT,
+    metric names are prefixed with URL_SSO_STATSD_PREFIX.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        host = host or url_sso_settings.STATSD_HOST
+        port = port or url_sso_settings.STATSD_PORT
+
+        if prefix is None:
+            prefix = url_sso_settings.STATSD_PREFIX
+
+        self.prefix = prefix + '.' if prefix else ''
+
+        # Resolve once, rather than for every metric
+        try:
+            host = socket.gethostbyname(host)
+        except socket.error:
+            logger.warning('Could not resolve statsd host %s', host)
+
+        self.address = (host, port)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, metric_type, tags):
+        data = '{0}{1}:{2}|{3}'.format(self.prefix, name, value, metric_type)
+
+        if tags:
+            data += '|#' + ','.join(
+                '{0}:{1}'.format(tag, tag_value)
+                for tag, tag_value in sorted(tags.iteritems())
+            )
+
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error:
+            # Metrics should never break rendering
+            logger.debug('Error sending metric %s', name, exc_info=True)
+
+    def timing(self, name, value, tags):
+        self._send(name, '%.2f' % value, 'ms', tags)
+
+    def increment(self, name, value, tags):
+        self._send(name, value, 'c', tags)
+
+
+class ServerTimings(object):
+    """
+    Durations collected for a single request, reported in the Server-Timing
+    header: time spent per plugin (`sso-<plugin>`) and in cache lookups
+    (`sso-cache`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.durations = {}
+
+    def add_timing(self, name, value, tags):
+        """ Add the duration of a timed block, if reported. """
+
+        if name == 'login_urls':
+            metric = 'sso-' + tags['plugin']
+        elif name == 'cache':
+            metric = 'sso-cache'
+        else:
+            return
+
+        with self._lock:
+            self.durations[metric] = self.durations.get(metric, 0) + value
+
+    def get_header(self):
+        """ Return value for the Server-Timing header. """
+
+        with self._lock:
+            return ', '.join(
+                '{0};dur={1:.1f}'.format(metric, duration)
+                for metric, duration in sorted(self.durations.iteritems())
+            )
+
+
+class _NullTimer(object):
+    """ Context manager doing nothing, used when metrics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+    """
+    Context manager recording the duration of its block, counting
+    exceptions raised within it as `<name>.errors`.
+    """
+
+    def __init__(self, sink, name, tags, server_timings=None):
+        self.sink = sink
+        self.name = name
+        self.tags = tags
+        self.server_timings = server_timings
+
+    def __enter__(self):
+        self.start = time.time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = (time.time() - self.start) * 1000
+
+        if self.sink.enabled:
+            self.sink.timing(self.name, duration, self.tags)
+
+            if exc_type is not None:
+                self.sink.increment(self.name + '.errors', 1, self.tags)
+
+        if self.server_timings is not None:
+            self.server_timings.add_timing(self.name, duration, self.tags)
+
+        return False
+
+
+class _Tagged(object):
+    """ Context manager adding tags to metrics emitted by this thread. """
+
+    def __init__(self, tags):
+        self.tags = tags
+
+    def __enter__(self):
+        self.previous = get_tags()
+        _local.tags = dict(self.previous, **self.tags)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.tags = self.previous
+
+        return False
+
+
+def get_sink():
+    """ Return the configured metrics sink. """
+
+    return url_sso_settings.METRICS
+
+
+def get_plugin_tag(sso_plugin):
+    """ Return the value to tag metrics for `sso_plugin` with. """
+
+    return getattr(
+        sso_plugin, 'settings_name', sso_plugin.__class__.__name__
+    ).lower()
+
+
+def get_tags():
+    """ Return tags added to metrics emitted by this thread. """
+
+    return getattr(_local, 'tags', {})
+
+
+def get_server_timings():
+    """ Return ServerTimings collected for this thread, or None. """
+
+    return getattr(_local, 'server_timings', None)
+
+
+def set_server_timings(server_timings):
+    """ Collect timings for this thread in `server_timings`, or stop. """
+
+    _local.server_timings = server_timings
+
+
+@contextmanager
+def collect_server_timings(server_timings):
+    """
+    Collect timings within the block in `server_timings`, i.e. in pool
+    threads working for a request.
+    """
+
+    previous = get_server_timings()
+    set_server_timings(server_timings)
+
+    try:
+        yield
+    finally:
+        set_server_timings(previous)
+
+
+def tagged(**tags):
+    """
+    Return a context manager adding `tags` to all metrics emitted by this
+    thread within its block.
+
+    Example::
+
+        with tagged(site='portal'):
+            plugin.get_url(url)
+    """
+
+    if not get_sink().enabled:
+        return _null_timer
+
+    return _Tagged(tags)
+
+
+def timed(name, **tags):
+    """
+    Return a context manager recording the duration of its block as `name`
+    and counting exceptions as `<name>.errors`.
+
+    Example::
+
+        with timed('backend', plugin='intershift'):
+            plugin.get_url(url)
+    """
+
+    sink = get_sink()
+    server_timings = get_server_timings()
+
+    if not sink.enabled and server_timings is None:
+        return _null_timer
+
+    return _Timer(sink, name, dict(get_tags(), **tags), server_timings)
+
+
+def increment(name, value=1, **tags):
+    """ Increment counter `name` by `value`. """
+
+    sink = get_sink()
+
+    if sink.enabled:
+        sink.increment(name, value, dict(get_tags(), **tags))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Middleware for django-url-sso. """
+
+from .settings import url_sso_settings
+from .metrics import ServerTimings, get_server_timings, set_server_timings
+
+
+class ServerTimingMiddleware(object):
+    """
+    Report time spent on SSO per response in a `Server-Timing` header, i.e.
+    `sso-intershift;dur=42.0, sso-iprova;dur=7.0, sso-cache;dur=1.0`.
+
+    Enabled for all responses when URL_SSO_SERVER_TIMING is True, or for
+    staff users only when it is 'staff'. In the latter case, place this
+    middleware after AuthenticationMiddleware.
+    """
+
+    def _is_enabled(self, request):
+        """ Return whether timings should be reported for `request`. """
+
+        server_timing = url_sso_settings.SERVER_TIMING
+
+        if server_timing == 'staff':
+            user = getattr(request, 'user', None)
+
+            return user is not None and user.is_staff
+
+        return bool(server_timing)
+
+    def process_request(self, request):
+        if self._is_enabled(request):
+            set_server_timings(ServerTimings())
+        else:
+            set_server_timings(None)
+
+    def process_response(self, request, response):
+        server_timings = get_server_timings()
+
+        if server_timings is None:
+            return response
+
+        set_server_timings(None)
+
+        header = server_timings.get_header()
+
+        if header:
+            if response.has_header('Server-Timing'):
+                header = response['Server-Timing'] + ', ' + header
+
+            response['Server-Timing'] = header
+
+        return response
@@ -19,4 +19,5 @@
 
 from django.db import models
 
-# Create your models here.
+# Make sure signal receivers are connected
+from . import signals
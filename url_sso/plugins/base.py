@@ -17,14 +17,194 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
+logger = logging.getLogger(__name__)
+
 import sys
+import time
+import threading
+import urlparse
+
 import requests
 
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.test.signals import setting_changed
 
-from url_sso.utils import Singleton
+from url_sso.utils import (
+    Singleton, SingleFlight, CircuitBreaker, LocalCache, HitCounter,
+    get_thread_pool, call_in_thread, get_remaining_time, get_rate_limiter
+)
 from url_sso.settings import url_sso_settings
-from url_sso.exceptions import RequestKeyException
+from url_sso.metrics import timed, increment, get_plugin_tag
+from url_sso.exceptions import (
+    RequestKeyException, InvalidResponseException, CircuitOpenException,
+    BudgetExhaustedException
+)
+
+
+# Circuit breakers by backend, reset when settings change
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_backend(url):
+    """ Return the backend (scheme and host) of `url`. """
+
+    parsed_url = urlparse.urlsplit(url)
+
+    return '{0}://{1}'.format(parsed_url.scheme, parsed_url.netloc)
+
+
+def get_circuit_breaker(url):
+    """
+    Return the circuit breaker for the backend (scheme and host) of `url`,
+    or None when circuit breakers are disabled.
+    """
+
+    if not url_sso_settings.CIRCUIT_BREAKER_THRESHOLD:
+        return None
+
+    backend = get_backend(url)
+
+    with _circuit_breakers_lock:
+        circuit_breaker = _circuit_breakers.get(backend)
+
+        if circuit_breaker is None:
+            if url_sso_settings.CIRCUIT_BREAKER_SHARED:
+                breaker_cache = cache
+            else:
+                breaker_cache = None
+
+            circuit_breaker = CircuitBreaker(
+                backend,
+                url_sso_settings.CIRCUIT_BREAKER_THRESHOLD,
+                url_sso_settings.CIRCUIT_BREAKER_RESET_TIMEOUT,
+                breaker_cache
+            )
+            _circuit_breakers[backend] = circuit_breaker
+
+    return circuit_breaker
+
+
+# In-process cache tier, reset when settings change
+_local_cache = None
+_local_cache_lock = threading.Lock()
+
+# Hits and misses of Django's (shared) cache
+shared_cache_stats = HitCounter()
+
+
+def get_local_cache():
+    """
+    Return the in-process cache in front of Django's cache, or None when it
+    is disabled.
+    """
+
+    global _local_cache
+
+    if not url_sso_settings.LOCAL_CACHE_ENTRIES:
+        return None
+
+    with _local_cache_lock:
+        if _local_cache is None:
+            _local_cache = LocalCache(url_sso_settings.LOCAL_CACHE_ENTRIES)
+
+        return _local_cache
+
+
+def get_cache_stats():
+    """
+    Return hit and miss counts of the in-process (`local`) and Django's
+    (`shared`) cache, for tuning cache sizes and timeouts.
+    """
+
+    local_cache = get_local_cache()
+
+    if local_cache is not None:
+        local_stats = local_cache.stats.as_dict()
+    else:
+        local_stats = {'hits': 0, 'misses': 0}
+
+    return {
+        'local': local_stats,
+        'shared': shared_cache_stats.as_dict()
+    }
+
+
+class TimeoutSession(requests.Session):
+    """
+    Requests session applying timeouts to every request, as
+    requests.Session has no notion of a default timeout.
+
+    Timeouts of requests for which the timeout was shortened to fit the
+    latency budget raise BudgetExhaustedException, as they say nothing
+    about the backend.
+    """
+
+    def __init__(self, get_timeout):
+        super(TimeoutSession, self).__init__()
+
+        self.get_timeout = get_timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.get_timeout()
+
+            capped = kwargs['timeout'] != (
+                url_sso_settings.CONNECT_TIMEOUT,
+                url_sso_settings.READ_TIMEOUT
+            )
+        else:
+            capped = False
+
+        try:
+            return super(TimeoutSession, self).request(method, url, **kwargs)
+        except requests.exceptions.Timeout, e:
+            if not capped:
+                raise
+
+            # Raise exception, retaining original traceback
+            traceback = sys.exc_info()[2]
+            raise BudgetExhaustedException(
+                'Latency budget exhausted waiting for backend: %s' % e
+            ), None, traceback
+
+
+def create_session(get_timeout, adapter, keep_alive=True):
+    """
+    Return a TimeoutSession sending requests through the (shared) `adapter`,
+    closing connections after each request when `keep_alive` is False.
+    """
+
+    session = TimeoutSession(get_timeout)
+    session.verify = True
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+class PluginConfig(object):
+    """
+    Validated, precompiled plugin settings exposed as plain attributes.
+
+    Example::
+
+        config = PluginConfig(secret='12345678', key_expiration=3600)
+        config.secret
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '<PluginConfig: %r>' % self.__dict__
 
 
 class SSOPluginBase(object):
@@ -32,12 +212,31 @@ class SSOPluginBase(object):
 
     __metaclass__ = Singleton
 
+    # Compiled settings, cleared by reset_config()
+    _config = None
+
+    # Keep-alive setting applying to the shared adapter
+    _keep_alive = True
+
+    # Errors which are never remembered, as they reflect the state of this
+    # process or request rather than the backend's answer for a key
+    uncached_errors = (CircuitOpenException, BudgetExhaustedException)
+
     def __init__(self):
-        """ Setup a Requests session. """
+        """
+        Setup thread-local Requests sessions sharing a connection pool.
+        """
+
+        self._sessions = threading.local()
+
+        self._adapter = None
+        self._adapter_lock = threading.Lock()
+
+        self.single_flight = SingleFlight()
 
-        self.session = requests.Session()
-        self.session.verify = True
-        self.session.timeout = url_sso_settings.REQUEST_TIMEOUT
+        # Stale keys scheduled for a background refresh
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
 
     def get_settings(self):
         """
@@ -67,15 +266,615 @@ class SSOPluginBase(object):
 
         return settings
 
-    def get_url(self, url, params={}):
+    def compile_settings(self, settings):
         """
-        Wrapper around requests.get() using sensible defaults.
+        Validate plugin settings and return a precompiled configuration,
+        such that the request path does not repeat validation and string
+        formatting. Override in plugins, the default returns `settings`.
+        """
+
+        return settings
+
+    def get_config(self):
+        """
+        Return the compiled plugin configuration, built once from
+        get_settings() and rebuilt after the settings change.
+        """
+
+        config = self._config
+
+        if config is None:
+            config = self.compile_settings(self.get_settings())
+            self._config = config
+
+        return config
+
+    def reset_config(self):
+        """ Forget the compiled configuration. """
+
+        self._config = None
+
+    def get_pool_settings(self):
+        """
+        Return connection pool settings; the URL_SSO_POOL_* and
+        URL_SSO_KEEP_ALIVE settings, overridden by the `pool_connections`,
+        `pool_maxsize`, `pool_block` and `keep_alive` plugin settings.
+        """
+
+        pool_settings = {
+            'pool_connections': url_sso_settings.POOL_CONNECTIONS,
+            'pool_maxsize': url_sso_settings.POOL_MAXSIZE,
+            'pool_block': url_sso_settings.POOL_BLOCK,
+            'keep_alive': url_sso_settings.KEEP_ALIVE
+        }
+
+        # Not all plugins have settings
+        settings_name = getattr(self, 'settings_name', None)
+        plugin_settings = getattr(url_sso_settings, settings_name, None) \
+            if settings_name else None
+
+        if plugin_settings:
+            for key in pool_settings:
+                if key in plugin_settings:
+                    pool_settings[key] = plugin_settings[key]
+
+        return pool_settings
+
+    def get_adapter(self):
+        """
+        Return the HTTP adapter shared by the sessions of all threads. Its
+        connection pool is thread safe, so connections (and TLS sessions)
+        are reused between threads.
+        """
+
+        with self._adapter_lock:
+            if self._adapter is None:
+                pool_settings = self.get_pool_settings()
+
+                self._adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool_settings['pool_connections'],
+                    pool_maxsize=pool_settings['pool_maxsize'],
+                    pool_block=pool_settings['pool_block']
+                )
+                self._keep_alive = pool_settings['keep_alive']
+
+            return self._adapter
+
+    def reset_adapter(self):
+        """
+        Forget the shared HTTP adapter; sessions are recreated on their
+        next use.
+        """
+
+        with self._adapter_lock:
+            self._adapter = None
+
+    @property
+    def session(self):
+        """
+        Return the Requests session for the current thread, as sessions
+        themselves are not guaranteed to be thread safe.
+        """
+
+        adapter = self.get_adapter()
+
+        if getattr(self._sessions, 'adapter', None) is not adapter:
+            self._sessions.session = create_session(
+                self.get_timeout, adapter, self._keep_alive
+            )
+            self._sessions.adapter = adapter
+
+        return self._sessions.session
+
+    def mint_many(self, cache, keys, mint, timeout):
+        """
+        Mint values for cache keys missing from `cache` using `mint(keys)`,
+        making sure concurrent requests for the same keys (in this process
+        or others sharing the cache) only hit the backend once.
+
+        Refer to `SingleFlight.mint_many()` for details.
+        """
+
+        return self.single_flight.mint_many(
+            cache, keys, mint, timeout,
+            lease_timeout=url_sso_settings.LEASE_TIMEOUT,
+            lease_wait=url_sso_settings.LEASE_WAIT
+        )
+
+    def _pack_cached(self, value, timeout, soft_timeout):
+        """
+        Return value to store in the cache for `timeout` seconds, along with
+        its soft expiry timestamp (None unless `soft_timeout` is set) and its
+        expiry timestamp.
+        """
+
+        now = time.time()
+
+        if soft_timeout:
+            soft_expiry = now + soft_timeout
+        else:
+            soft_expiry = None
+
+        return (value, soft_expiry, now + timeout)
+
+    def _unpack_cached(self, entry):
+        """
+        Return (value, soft_expiry, expiry) for a cached entry, with None for
+        expiries not stored with it.
+        """
+
+        if not isinstance(entry, tuple):
+            return (entry, None, None)
+
+        if len(entry) == 2:
+            # Stored with a soft expiry only
+            return entry + (None, )
+
+        return entry
+
+    def _set_local_many(self, entries, timeout):
+        """
+        Store cached entries in the in-process cache, if enabled, such that
+        they never outlive their expiry in the shared cache.
+        """
+
+        local_cache = get_local_cache()
+
+        if local_cache is None:
+            return
+
+        now = time.time()
+
+        local_timeout = min(url_sso_settings.LOCAL_CACHE_TIMEOUT, timeout)
+
+        for key, entry in entries.iteritems():
+            value, soft_expiry, expiry = self._unpack_cached(entry)
+
+            if not value:
+                continue
+
+            if expiry is not None:
+                entry_timeout = min(local_timeout, expiry - now)
+
+                if entry_timeout <= 0:
+                    continue
+            else:
+                entry_timeout = local_timeout
+
+            local_cache.set(key, entry, entry_timeout)
+
+    def invalidate_local(self, keys):
+        """ Remove keys from the in-process cache, if enabled. """
+
+        local_cache = get_local_cache()
+
+        if local_cache is not None:
+            local_cache.delete_many(keys)
+
+    def get_user_cache_keys(self, username):
+        """
+        Return cache keys for the keys or tokens of a user, which are removed
+        from the in-process cache when the user logs out.
+        """
+
+        return []
+
+    def _refresh_many(self, cache, keys, mint, timeout):
+        """
+        Mint values for stale keys, skipping keys refreshed since they were
+        scheduled and logging failures.
         """
 
         try:
-            r = self.session.get(
-                url, params=params
+            entries = cache.get_many(keys)
+
+            now = time.time()
+
+            fresh = {}
+            for key, entry in entries.iteritems():
+                value, soft_expiry = self._unpack_cached(entry)[:2]
+
+                if value and (soft_expiry is None or soft_expiry > now):
+                    fresh[key] = entry
+
+            # Replace stale values in the in-process cache
+            self._set_local_many(fresh, timeout)
+
+            stale = [key for key in keys if key not in fresh]
+
+            if stale:
+                minted = self.mint_many(cache, stale, mint, timeout)
+
+                self._set_local_many(minted, timeout)
+        except RequestKeyException:
+            logger.exception('Error refreshing %s', keys)
+        except Exception:
+            # Nobody reads the result of the refresh task
+            logger.exception('Unexpected error refreshing %s', keys)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.difference_update(keys)
+
+    def get_error_timeout(self, exception):
+        """
+        Return seconds to remember `exception` for a key, as configured
+        for its class (or closest base class) in URL_SSO_ERROR_TIMEOUTS, or
+        None when it should not be remembered.
+        """
+
+        if isinstance(exception, self.uncached_errors):
+            return None
+
+        error_timeouts = url_sso_settings.ERROR_TIMEOUTS
+
+        for exception_class in type(exception).__mro__:
+            exception_path = '{0}.{1}'.format(
+                exception_class.__module__, exception_class.__name__
+            )
+
+            if exception_path in error_timeouts:
+                return error_timeouts[exception_path]
+
+        return None
+
+    def _get_error_key(self, key):
+        """ Return cache key for a failure to mint `key`. """
+        return '{0}_error'.format(key)
+
+    def _get_failed_keys(self, cache, keys):
+        """ Return the subset of `keys` for which minting recently failed. """
+
+        error_keys = [self._get_error_key(key) for key in keys]
+        errors = cache.get_many(error_keys)
+
+        return set(
+            key for key, error_key in zip(keys, error_keys)
+            if error_key in errors
+        )
+
+    def _cache_errors(self, cache, errors):
+        """
+        Remember failures from a dict of exceptions by key, such that the
+        keys are not requested again until their error timeout passes.
+        """
+
+        for key, exception in errors.iteritems():
+            error_timeout = self.get_error_timeout(exception)
+
+            if error_timeout:
+                cache.set(
+                    self._get_error_key(key),
+                    '{0}: {1}'.format(type(exception).__name__, exception),
+                    error_timeout
+                )
+
+    def get_or_mint_many(self, cache, keys, mint, timeout, soft_timeout=None):
+        """
+        Return a dict with values for `keys`, read from `cache` with a single
+        `get_many()` and minted through `mint_many()` when missing.
+
+        With URL_SSO_LOCAL_CACHE_ENTRIES set, values are first looked up in
+        an in-process cache and `cache` is only read for keys missing there.
+
+        With `soft_timeout` set, values are stored with a soft expiry. Values
+        past their soft expiry are still returned, while fresh values are
+        minted in the background. Requests only block on the backend once a
+        value has expired from the cache (after `timeout` seconds).
+
+        `mint()` may return exceptions in place of values for keys it failed
+        to mint. With URL_SSO_ERROR_TIMEOUTS configured, such failures are
+        remembered in the cache and the keys are skipped without requesting
+        them from the backend until the error expires.
+        """
+
+        negative_caching = bool(url_sso_settings.ERROR_TIMEOUTS)
+
+        local_cache = get_local_cache()
+
+        plugin_tag = get_plugin_tag(self)
+
+        if local_cache is not None:
+            entries = local_cache.get_many(keys)
+
+            shared_keys = [key for key in keys if key not in entries]
+
+            increment(
+                'cache.hits', len(entries), plugin=plugin_tag, tier='local'
+            )
+            increment(
+                'cache.misses', len(shared_keys), plugin=plugin_tag,
+                tier='local'
+            )
+        else:
+            entries = {}
+
+            shared_keys = keys
+
+        failed = set()
+
+        if shared_keys:
+            if negative_caching:
+                error_keys = dict(
+                    (self._get_error_key(key), key) for key in shared_keys
+                )
+
+                with timed('cache', plugin=plugin_tag, tier='shared'):
+                    shared_entries = cache.get_many(
+                        shared_keys + error_keys.keys()
+                    )
+
+                failed = set(
+                    error_keys[error_key] for error_key in error_keys
+                    if error_key in shared_entries
+                )
+            else:
+                with timed('cache', plugin=plugin_tag, tier='shared'):
+                    shared_entries = cache.get_many(shared_keys)
+
+            shared_entries = dict(
+                (key, shared_entries[key]) for key in shared_keys
+                if key in shared_entries
+            )
+
+            shared_hits = len(shared_entries)
+            shared_misses = len(shared_keys) - shared_hits
+
+            shared_cache_stats.record(shared_hits, shared_misses)
+
+            increment(
+                'cache.hits', shared_hits, plugin=plugin_tag, tier='shared'
+            )
+            increment(
+                'cache.misses', shared_misses, plugin=plugin_tag,
+                tier='shared'
+            )
+
+            self._set_local_many(shared_entries, timeout)
+
+            entries.update(shared_entries)
+
+        values = {}
+        stale = []
+
+        now = time.time()
+
+        for key in keys:
+            if key not in entries:
+                continue
+
+            value, soft_expiry = self._unpack_cached(entries[key])[:2]
+
+            if not value:
+                continue
+
+            values[key] = value
+
+            if soft_expiry is not None and soft_expiry <= now:
+                stale.append(key)
+
+        def packed_mint(mint_keys):
+            """ Mint values, remembering failures and packing values. """
+
+            if negative_caching:
+                # Minting may have failed elsewhere since reading the cache
+                failed_keys = self._get_failed_keys(cache, mint_keys)
+                mint_keys = [key for key in mint_keys if key not in failed_keys]
+
+                if not mint_keys:
+                    return {}
+
+            try:
+                minted = mint(mint_keys)
+            except RequestKeyException, e:
+                self._cache_errors(cache, dict.fromkeys(mint_keys, e))
+
+                raise
+
+            errors = dict(
+                (key, value) for key, value in minted.iteritems()
+                if isinstance(value, Exception)
+            )
+
+            if errors:
+                self._cache_errors(cache, errors)
+
+            return dict(
+                (key, self._pack_cached(value, timeout, soft_timeout))
+                for key, value in minted.iteritems()
+                if key not in errors
+            )
+
+        if failed:
+            logger.debug('Skipping %s after recent errors', sorted(failed))
+
+        # Mint missing values
+        misses = [
+            key for key in keys if key not in values and key not in failed
+        ]
+        if misses:
+            minted = self.mint_many(cache, misses, packed_mint, timeout)
+
+            self._set_local_many(minted, timeout)
+
+            for key, entry in minted.iteritems():
+                values[key] = self._unpack_cached(entry)[0]
+
+        # Refresh stale values in the background, once
+        stale = [
+            key for key in stale
+            if key not in failed and not self.single_flight.in_flight(key)
+        ]
+        with self._refreshing_lock:
+            stale = [key for key in stale if key not in self._refreshing]
+            self._refreshing.update(stale)
+
+        if stale:
+            pool = get_thread_pool('refresh', url_sso_settings.MAX_WORKERS)
+            pool.apply_async(
+                call_in_thread,
+                (self._refresh_many, cache, stale, packed_mint, timeout)
+            )
+
+        return values
+
+    def get_login_url_keys(self):
+        """
+        Return the context keys this plugin may provide, without contacting
+        any backend. This allows the context processor to only call the
+        plugin when one of its keys is used.
+
+        Returns None when the keys are unknown, which is the default.
+        """
+
+        return None
+
+    def get_login_url(self, request, name):
+        """
+        Return the login URL for a single site or service `name` of this
+        plugin, only requesting the key it needs. Returns None when the
+        user has no access, `name` is unknown or, by default, when the
+        plugin does not support single login URL's.
+        """
+
+        return None
+
+    def get_login_url_names(self, request):
+        """
+        Return a dict with the names of sites or services the user of
+        `request` may access by context key, for use with `get_login_url()`,
+        without contacting any backend. Returns None when the plugin does
+        not support single login URL's, which is the default.
+        """
+
+        return None
+
+    def prewarm(self, request):
+        """
+        Mint and cache keys or tokens for the user of `request`, returning a
+        list with the exceptions raised for login URL's failing.
+
+        Login URL's are minted one at a time with `get_login_url()` when the
+        plugin supports it, otherwise with `get_login_urls()`.
+        """
+
+        names = self.get_login_url_names(request)
+
+        if names is None:
+            try:
+                self.get_login_urls(request)
+            except RequestKeyException, e:
+                return [e]
+
+            return []
+
+        errors = []
+
+        for name in names.values():
+            try:
+                self.get_login_url(request, name)
+            except RequestKeyException, e:
+                errors.append(e)
+
+        return errors
+
+    def get_timeout(self):
+        """
+        Return (connect, read) timeout for backend requests, limited by the
+        time remaining in the latency budget of the current request.
+
+        Raises BudgetExhaustedException when the budget is exhausted.
+        """
+
+        connect_timeout = url_sso_settings.CONNECT_TIMEOUT
+        read_timeout = url_sso_settings.READ_TIMEOUT
+
+        remaining = get_remaining_time()
+
+        if remaining is not None:
+            if remaining <= 0:
+                raise BudgetExhaustedException('Latency budget exhausted.')
+
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+
+        return (connect_timeout, read_timeout)
+
+    def call_backend(self, url, func, *args, **kwargs):
+        """
+        Return `func(*args, **kwargs)`, guarded by the circuit breaker for
+        the backend of `url`. Raises CircuitOpenException without calling
+        `func` when the breaker is open.
+
+        Exceptions and HTTP responses with a server error status count as
+        failures, except for an exhausted latency budget and
+        InvalidResponseException, which means the backend did answer.
+
+        Calls are spaced by the rate limiter for the current thread, if any.
+        """
+
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None:
+            rate_limiter.wait(get_backend(url))
+
+        plugin_tag = get_plugin_tag(self)
+
+        increment('backend.calls', plugin=plugin_tag)
+
+        with timed('backend', plugin=plugin_tag):
+            result = self._call_backend(url, func, *args, **kwargs)
+
+        if getattr(result, 'status_code', 200) >= 500:
+            increment('backend.errors', plugin=plugin_tag)
+
+        return result
+
+    def _call_backend(self, url, func, *args, **kwargs):
+        """ Call `func`, guarded by the circuit breaker for `url`. """
+
+        circuit_breaker = get_circuit_breaker(url)
+
+        if circuit_breaker is None:
+            return func(*args, **kwargs)
+
+        # Don't take a half-open trial without time left to perform it
+        remaining = get_remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise BudgetExhaustedException('Latency budget exhausted.')
+
+        if not circuit_breaker.allow():
+            raise CircuitOpenException(
+                'Circuit breaker open for %s.' % circuit_breaker.name
             )
+
+        try:
+            result = func(*args, **kwargs)
+        except BudgetExhaustedException:
+            # Says nothing about the backend, release a trial if taken
+            circuit_breaker.release()
+            raise
+        except InvalidResponseException:
+            # The backend answered, i.e. with a SOAP fault
+            circuit_breaker.record_success()
+            raise
+        except:
+            circuit_breaker.record_failure()
+            raise
+
+        if getattr(result, 'status_code', 200) >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+
+        return result
+
+    def _send(self, method, url, **kwargs):
+        """
+        Send request through the session, raising RequestKeyException
+        on errors.
+        """
+
+        try:
+            r = self.session.request(method, url, **kwargs)
         except requests.exceptions.RequestException, e:
             # Raise exception, retaining original traceback
             traceback = sys.exc_info()[2]
@@ -83,3 +882,50 @@ class SSOPluginBase(object):
                 None, traceback
 
         return r
+
+    def get_url(self, url, params={}):
+        """
+        Wrapper around requests.get() using sensible defaults.
+        """
+
+        return self.call_backend(
+            url, self._send, 'GET', url, params=params
+        )
+
+
+@receiver(setting_changed)
+def reset_plugin_configs(sender, setting, **kwargs):
+    """ Make sure changes to plugin settings (i.e. in tests) apply. """
+
+    for instance in Singleton._instances.values():
+        if not isinstance(instance, SSOPluginBase):
+            continue
+
+        settings_name = getattr(instance, 'settings_name', None)
+        if setting == '%s_%s' % (url_sso_settings.settings_prefix, settings_name):
+            instance.reset_config()
+            instance.reset_adapter()
+
+        elif setting.startswith('URL_SSO_POOL_') or \
+                setting == 'URL_SSO_KEEP_ALIVE':
+            instance.reset_adapter()
+
+
+@receiver(setting_changed)
+def reset_local_cache(sender, setting, **kwargs):
+    """ Make sure changes to in-process cache settings apply. """
+
+    global _local_cache
+
+    if setting.startswith('URL_SSO_LOCAL_CACHE_'):
+        with _local_cache_lock:
+            _local_cache = None
+
+
+@receiver(setting_changed)
+def reset_circuit_breakers(sender, setting, **kwargs):
+    """ Make sure changes to circuit breaker settings apply. """
+
+    if setting.startswith('URL_SSO_CIRCUIT_BREAKER_'):
+        with _circuit_breakers_lock:
+            _circuit_breakers.clear()
@@ -19,36 +19,137 @@
 
 """ SSO for Intershift http://www.intershift.nl/ """
 
+import logging
+logger = logging.getLogger(__name__)
+
+import re
 import urllib
 import sys
+import threading
+
+from xml.sax.saxutils import unescape
 
 from lxml import etree
 
 from django.core.cache import cache
 
-from url_sso.plugins.base import SSOPluginBase
-from url_sso.exceptions import RequestKeyException
+from url_sso.plugins.base import SSOPluginBase, PluginConfig
+from url_sso.exceptions import (
+    RequestKeyException, InvalidResponseException
+)
+from url_sso.utils import get_thread_pool, submit_call
+from url_sso.metrics import tagged
+
+
+# Value attribute of the key element, e.g. <key value="BOGUSKEY" />, but
+# not data-value="..." or ns:value="..."
+KEY_VALUE_RE = re.compile(
+    r'<key\s[^>]*?(?<![\w.:-])value\s*=\s*(["\'])(.*?)\1', re.DOTALL
+)
+
+# Markup which the scan can't interpret, i.e. a commented out key element,
+# leaving such responses to the parser
+UNSCANNABLE = ('<!--', '<![CDATA[')
+
+# Entities which may occur in attribute values, besides &amp;, &lt; and &gt;
+ATTRIBUTE_ENTITIES = {'&quot;': '"', '&apos;': "'"}
 
 
 class IntershiftPlugin(SSOPluginBase):
     settings_name = 'INTERSHIFT'
 
+    def compile_settings(self, settings):
+        """ Validate settings and precompile site URL's and context keys. """
+
+        assert 'sites' in settings
+        assert 'secret' in settings
+        assert 'key_expiration' in settings
+
+        key_soft_expiration = settings.get('key_soft_expiration')
+        assert key_soft_expiration is None or \
+            key_soft_expiration < settings['key_expiration']
+
+        sites = {}
+        for site_name, site in settings['sites'].iteritems():
+            assert 'url' in site
+
+            sites[site_name] = PluginConfig(
+                name=site_name,
+                url=site['url'],
+                context_key=self._get_login_url_key(site_name),
+                has_access=site.get('has_access', lambda request: True)
+            )
+
+        return PluginConfig(
+            secret=settings['secret'],
+            key_expiration=settings['key_expiration'],
+            key_soft_expiration=key_soft_expiration,
+            max_workers=settings.get('max_workers', 1),
+            sites=sites,
+            site_names=sorted(sites.keys())
+        )
+
     def _get_site_url(self, site_name):
         """ Util method to get site url from name. """
 
-        settings = self.get_settings()
+        config = self.get_config()
 
-        assert 'sites' in settings
-        assert site_name in settings['sites'].keys()
-        assert 'url' in settings['sites'][site_name]
+        assert site_name in config.sites
+
+        return config.sites[site_name].url
+
+    def __init__(self):
+        super(IntershiftPlugin, self).__init__()
+
+        # XML parsers per thread, as lxml parsers are not thread safe
+        self._parsers = threading.local()
+
+    def _get_parser(self):
+        """ Return an XML parser with recovery enabled for this thread. """
+
+        parser = getattr(self._parsers, 'parser', None)
+
+        if parser is None:
+            parser = etree.XMLParser(recover=True)
+            self._parsers.parser = parser
 
-        return settings['sites'][site_name]['url']
+        return parser
+
+    def _scan_login_key(self, data):
+        """
+        Return login key from the value attribute of the first key element
+        in `data`, without parsing the document, or None if not found or
+        the response has markup only a parser interprets correctly.
+        """
+
+        match = KEY_VALUE_RE.search(data)
+
+        if match is None:
+            return None
+
+        preceding = data[:match.start()]
+        if any(markup in preceding for markup in UNSCANNABLE):
+            return None
+
+        value = match.group(2)
+
+        # Character references are not handled by unescape()
+        if '&#' in value:
+            return None
+
+        return unescape(value, ATTRIBUTE_ENTITIES) or None
 
     def _parse_login_key(self, data):
         """ Parse returned (broken) XML and return loginkey. """
 
+        # Scanning for the key is much faster than parsing
+        value = self._scan_login_key(data)
+
+        if value:
+            return value
+
         # Use parse with recovery enabled
-        parser = etree.XMLParser(recover=True)
+        parser = self._get_parser()
 
         try:
             root = etree.fromstring(data, parser)
@@ -57,37 +158,35 @@ class IntershiftPlugin(SSOPluginBase):
         except Exception, e:
             # Raise exception, retaining original traceback
             traceback = sys.exc_info()[2]
-            raise RequestKeyException('Error parsing XML: %s' % e), \
+            raise InvalidResponseException('Error parsing XML: %s' % e), \
                 None, traceback
 
         if not value:
-            raise RequestKeyException('No value found in login key response.')
+            raise InvalidResponseException(
+                'No value found in login key response.'
+            )
 
         return value
 
     def _request_login_key(self, site_name, username):
         """ Request and return login URL for a particular site and user. """
 
-        settings = self.get_settings()
-
-        assert 'secret' in settings
-
         # Send out request
         r = self.get_url(
             self._get_site_url(site_name),
             params={
                 'user': username,
-                'secret': settings['secret']
+                'secret': self.get_config().secret
             }
         )
 
         if not r.status_code == 200:
-            raise RequestKeyException(
+            raise InvalidResponseException(
                 'Request returned an error status.'
             )
 
         if not r.content:
-            raise RequestKeyException(
+            raise InvalidResponseException(
                 'Login key request returned no content.'
             )
 
@@ -99,35 +198,151 @@ class IntershiftPlugin(SSOPluginBase):
             site=site_name, user=username
         )
 
+    def get_user_cache_keys(self, username):
+        """ Return cache keys for the login URL's of a user for all sites. """
+
+        return [
+            self._get_cache_key(site_name, username)
+            for site_name in self.get_config().site_names
+        ]
+
+    def _request_login_url(self, site_name, username):
+        """ Request a login key and return login URL for site and user. """
+
+        # Fetch a login key, tagging metrics with the site
+        with tagged(site=site_name):
+            login_key = self._request_login_key(site_name, username)
+
+        # Get site URL
+        site_url = self._get_site_url(site_name)
+
+        params = urllib.urlencode({
+            'user': username,
+            'key': login_key
+        })
+
+        # Generate login url
+        return '{url}?{params}'.format(url=site_url, params=params)
+
     def _generate_login_url(self, site_name, username):
         """ Generate and return a login URL from site_name and username. """
 
-        settings = self.get_settings()
+        config = self.get_config()
 
         cache_key = self._get_cache_key(site_name, username)
-        cache_timeout = settings['key_expiration']
 
-        # Attempt to get key from cache
-        login_url = cache.get(cache_key)
+        # Attempt to get key from cache, otherwise fetch a login key and
+        # store it in the cache for later use
+        login_urls = self.get_or_mint_many(
+            cache, [cache_key],
+            lambda cache_keys: {
+                cache_key: self._request_login_url(site_name, username)
+            },
+            config.key_expiration, config.key_soft_expiration
+        )
+
+        login_url = login_urls.get(cache_key)
+
         if not login_url:
-            # Fetch a login key
-            login_key = self._request_login_key(site_name, username)
+            raise RequestKeyException('No login key obtained for site.')
 
-            # Get site URL
-            site_url = self._get_site_url(site_name)
+        return login_url
 
-            params = urllib.urlencode({
-                'user': username,
-                'key': login_key
-            })
+    def _request_site_login_url(self, site_name, username):
+        """
+        Return login URL for site and user, or the exception raised when
+        requesting the login key fails.
+        """
+
+        try:
+            return self._request_login_url(site_name, username)
+        except RequestKeyException, e:
+            # Log the stack trace but don't discard other sites
+            logger.exception(
+                'Error requesting login key for site %s', site_name
+            )
 
-            # Generate login url
-            login_url = '{url}?{params}'.format(url=site_url, params=params)
+            return e
 
-            # Store cached value for later use
-            cache.set(cache_key, login_url, cache_timeout)
+    def _request_login_urls(self, site_names, username):
+        """
+        Request login URL's for sites and user, returning a list with a
+        login URL or exception for each site, in the same order.
 
-        return login_url
+        Keys are requested concurrently when `max_workers` is set to more
+        than 1 in the settings. The pool is shared by all requests in the
+        process; keys no pool thread has started requesting by the time they
+        are needed are requested from the current thread.
+        """
+
+        max_workers = self.get_config().max_workers
+
+        if max_workers > 1 and len(site_names) > 1:
+            pool = get_thread_pool('intershift', max_workers)
+
+            # Request keys in pool threads, sharing the current deadline
+            calls = [
+                submit_call(
+                    pool, self._request_site_login_url, site_name, username
+                ) for site_name in site_names
+            ]
+
+            login_urls = []
+            for call in calls:
+                call.run_here()
+
+                login_urls.append(call.get())
+
+            return login_urls
+
+        return [
+            self._request_site_login_url(site_name, username)
+            for site_name in site_names
+        ]
+
+    def _generate_login_urls(self, site_names, username):
+        """
+        Generate login URL's for multiple sites, returning a list of
+        (site_name, login_url) tuples in the same order as `site_names` and
+        leaving out sites for which requesting a key failed.
+
+        The cache is read with a single `get_many()` and newly requested
+        URL's are stored with a single `set_many()`. Concurrent requests for
+        the same sites and user only request keys once.
+        """
+
+        config = self.get_config()
+
+        cache_keys = [
+            self._get_cache_key(site_name, username)
+            for site_name in site_names
+        ]
+        site_names_by_key = dict(zip(cache_keys, site_names))
+
+        def mint(mint_keys):
+            """
+            Request login URL's, returning a dict with a login URL or
+            exception by cache key.
+            """
+
+            requested_urls = self._request_login_urls(
+                [site_names_by_key[cache_key] for cache_key in mint_keys],
+                username
+            )
+
+            return dict(zip(mint_keys, requested_urls))
+
+        # Get URL's from cache, requesting and storing missing URL's
+        login_urls = self.get_or_mint_many(
+            cache, cache_keys, mint,
+            config.key_expiration, config.key_soft_expiration
+        )
+
+        return [
+            (site_name, login_urls[cache_key])
+            for site_name, cache_key in zip(site_names, cache_keys)
+            if login_urls.get(cache_key)
+        ]
 
     def _get_login_url_key(self, site_name):
         """ Utility method returning context key for login URL. """
@@ -145,29 +360,80 @@ class IntershiftPlugin(SSOPluginBase):
 
         return self._generate_login_url(site_name, user.username)
 
+    def get_login_url_keys(self):
+        """ Return context keys for all configured sites. """
+
+        config = self.get_config()
+
+        return [config.sites[site_name].context_key
+                for site_name in config.site_names]
+
+    def _get_login_urls(self, site_names, user):
+        """
+        Return a list of (site_name, login_url) tuples for the given sites
+        and user, in the same order, leaving out failing sites.
+        """
+
+        assert user.is_authenticated(), 'User not authenticated.'
+
+        return self._generate_login_urls(site_names, user.username)
+
+    def get_login_url(self, request, site_name):
+        """
+        Return login URL for a single site, or None when the site is not
+        configured or the user has no access to it.
+        """
+
+        site = self.get_config().sites.get(site_name)
+
+        if site is None or not request.user.is_authenticated():
+            return None
+
+        if not site.has_access(request):
+            return None
+
+        return self._get_login_url(site_name, request.user)
+
+    def get_login_url_names(self, request):
+        """ Return names of sites the user may access by context key. """
+
+        config = self.get_config()
+
+        if not request.user.is_authenticated():
+            return {}
+
+        return dict(
+            (config.sites[site_name].context_key, site_name)
+            for site_name in config.site_names
+            if config.sites[site_name].has_access(request)
+        )
+
     def get_login_urls(self, request):
         """ Return login URLs for all configured sites. """
 
-        settings = self.get_settings()
+        config = self.get_config()
 
         login_urls = {}
 
         # Only perform for logged in users
         if request.user.is_authenticated():
-            for site_name, site in settings['sites'].iteritems():
+            site_names = []
 
+            for site_name in config.site_names:
                 # Determine whether user has access rights
-                has_access = site.get('has_access', lambda request: True)
-                if not has_access(request):
+                if not config.sites[site_name].has_access(request):
                     # has_access(request) is defined and user does not have
                     # access to this site - skip.
                     continue
 
-                # Get login URL for site and request (user)
-                login_url = self._get_login_url(site_name, request.user)
+                site_names.append(site_name)
+
+            # Get login URL for sites and request (user)
+            site_login_urls = self._get_login_urls(site_names, request.user)
 
-                # Generate name for URL in context
-                login_url_key = self._get_login_url_key(site_name)
+            for site_name, login_url in site_login_urls:
+                # Name for URL in context
+                login_url_key = config.sites[site_name].context_key
 
                 # Add key and URL to login_urls dictionary
                 assert not login_url_key in login_urls, 'Duplicate URL.'
@@ -19,33 +19,108 @@
 
 """ SSO for iProva http://www.infoland.nl/ """
 
+import logging
+logger = logging.getLogger(__name__)
+
 import sys
+import threading
+
+from xml.sax.saxutils import escape
 
 import suds.client
 import suds_requests
 
+from lxml import etree
+
 from django.core.cache import cache
 
-from url_sso.exceptions import RequestKeyException
+from url_sso.exceptions import (
+    RequestKeyException, InvalidResponseException, CircuitOpenException,
+    BudgetExhaustedException
+)
 from url_sso.utils import SudsDjangoCache
+from url_sso.metrics import timed, get_plugin_tag
+
+from url_sso.plugins.base import SSOPluginBase, PluginConfig
 
-from url_sso.plugins.base import SSOPluginBase
+
+# Namespace of the iProva core webservices
+IPROVA_NAMESPACE = 'http://www.infoland.nl/suite/core/'
+
+# Namespace of SOAP 1.1 envelopes
+SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+# Prebuilt SOAP 1.1 request for GetTokenForUser
+GET_TOKEN_ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soap:Body>'
+    '<GetTokenForUser xmlns="{namespace}">'
+    '<strTrustedApplicationID>{application_id}</strTrustedApplicationID>'
+    '<strLoginCode>{username}</strLoginCode>'
+    '</GetTokenForUser>'
+    '</soap:Body>'
+    '</soap:Envelope>'
+)
 
 
 class iProvaPlugin(SSOPluginBase):
     settings_name = 'IPROVA'
 
-    def _get_webservice(self):
-        """ Return SOAP client (suds). """
+    def __init__(self):
+        """ Setup storage for per-thread SOAP clients. """
+
+        super(iProvaPlugin, self).__init__()
+
+        self._local = threading.local()
+
+    def compile_settings(self, settings):
+        """ Validate settings and precompile service URL's and keys. """
 
-        settings = self.get_settings()
         assert 'root_url' in settings
+        assert 'services' in settings
+        assert 'key_expiration' in settings
+        assert 'application_id' in settings
+
         root_url = settings['root_url']
+        application_id = settings['application_id']
+
+        assert isinstance(application_id, basestring)
+
+        key_soft_expiration = settings.get('key_soft_expiration')
+        assert key_soft_expiration is None or \
+            key_soft_expiration < settings['key_expiration']
 
-        webservice_url = (
-            root_url + 'Management/Webservices/UserManagementAPI.asmx?WSDL'
+        services = []
+        for service in settings['services']:
+            services.append(PluginConfig(
+                name=service,
+                url='{0}{1}/'.format(root_url, service),
+                context_key=self._get_login_url_key(service)
+            ))
+
+        endpoint_url = (
+            root_url + 'Management/Webservices/UserManagementAPI.asmx'
+        )
+
+        return PluginConfig(
+            root_url=root_url,
+            endpoint_url=endpoint_url,
+            webservice_url=endpoint_url + '?WSDL',
+            fast_soap=settings.get('fast_soap', False),
+            application_id=application_id,
+            key_expiration=settings['key_expiration'],
+            key_soft_expiration=key_soft_expiration,
+            # Method to determine access for request (user), service
+            has_access=settings.get(
+                'has_access', lambda request, service: True
+            ),
+            services=services
         )
 
+    def _create_client(self, webservice_url):
+        """ Create and return SOAP client (suds). """
+
         suds_cache = SudsDjangoCache()
 
         client = suds.client.Client(
@@ -58,17 +133,123 @@ class iProvaPlugin(SSOPluginBase):
 
         assert client.options.cache == suds_cache
 
-        return client.service
+        return client
 
-    def _request_token(self, username):
-        """ Request login token for a particular user. """
+    def _get_client(self):
+        """
+        Return SOAP client for the current thread, created once and reused
+        until the webservice URL changes. Suds clients keep state between
+        calls, hence they are not shared between threads.
+        """
 
-        settings = self.get_settings()
-        assert 'application_id' in settings
-        application_id = settings['application_id']
+        webservice_url = self.get_config().webservice_url
 
-        assert isinstance(application_id, basestring)
-        assert isinstance(username, basestring)
+        client = getattr(self._local, 'client', None)
+
+        if client is None or self._local.webservice_url != webservice_url:
+            client = self._create_client(webservice_url)
+
+            self._local.client = client
+            self._local.webservice_url = webservice_url
+
+        return client
+
+    def _reset_client(self):
+        """ Forget the SOAP client for the current thread. """
+
+        self._local.client = None
+
+    def _get_webservice(self):
+        """ Return SOAP service (suds). """
+
+        return self._get_client().service
+
+    def _parse_token_response(self, content):
+        """
+        Return token from a GetTokenForUser SOAP response, or None when the
+        response is not as expected.
+        """
+
+        try:
+            root = etree.fromstring(content)
+        except etree.XMLSyntaxError:
+            return None
+
+        result = root.find(
+            './/{%s}GetTokenForUserResult' % IPROVA_NAMESPACE
+        )
+
+        if result is None or not result.text:
+            return None
+
+        return result.text
+
+    def _parse_fault(self, content):
+        """
+        Return the fault string of a SOAP fault response, or None when the
+        response is not a SOAP fault.
+        """
+
+        try:
+            root = etree.fromstring(content)
+        except etree.XMLSyntaxError:
+            return None
+
+        fault = root.find('.//{%s}Fault' % SOAP_NAMESPACE)
+
+        if fault is None:
+            return None
+
+        return fault.findtext('faultstring') or ''
+
+    def _send_soap(self, url, data, headers):
+        """
+        Post a SOAP request, raising InvalidResponseException when the
+        service answers with a SOAP fault.
+        """
+
+        r = self._send('POST', url, data=data, headers=headers)
+
+        if r.status_code != 200:
+            fault = self._parse_fault(r.content)
+
+            if fault is not None:
+                raise InvalidResponseException('SOAP fault: %s' % fault)
+
+        return r
+
+    def _request_token_fast(self, username):
+        """
+        Request login token by posting a prebuilt SOAP envelope, bypassing
+        suds. Returns None on unexpected responses, raises
+        InvalidResponseException on SOAP faults.
+        """
+
+        config = self.get_config()
+
+        envelope = GET_TOKEN_ENVELOPE.format(
+            namespace=IPROVA_NAMESPACE,
+            application_id=escape(config.application_id),
+            username=escape(username)
+        )
+
+        r = self.call_backend(
+            config.endpoint_url, self._send_soap, config.endpoint_url,
+            envelope.encode('utf-8'), {
+                'Content-Type': 'text/xml; charset=utf-8',
+                'SOAPAction': '"%sGetTokenForUser"' % IPROVA_NAMESPACE
+            }
+        )
+
+        if r.status_code != 200:
+            return None
+
+        return self._parse_token_response(r.content)
+
+    def _request_token_suds(self, username):
+        """ Request login token for a particular user through suds. """
+
+        application_id = self.get_config().application_id
 
         try:
             webservice = self._get_webservice()
@@ -78,6 +259,17 @@ class iProvaPlugin(SSOPluginBase):
                 strLoginCode=username
             )
 
+        except (BudgetExhaustedException, CircuitOpenException):
+            # Raised by our own session within the transport, these say
+            # nothing about the backend
+            raise
+
+        except suds.WebFault, e:
+            # The service answered, but refused the request
+            traceback = sys.exc_info()[2]
+            raise InvalidResponseException('SOAP fault: %s' % e), \
+                None, traceback
+
         except Exception, e:
             # Raise exception, retaining original traceback
             traceback = sys.exc_info()[2]
@@ -86,53 +278,149 @@ class iProvaPlugin(SSOPluginBase):
 
         return result
 
+    def _request_token(self, username):
+        """
+        Request login token for a particular user.
+
+        With `fast_soap` enabled, a prebuilt SOAP request is tried first,
+        falling back to suds on unexpected responses other than SOAP faults.
+
+        SOAP calls are timed as `soap`, tagged with the `path` taken.
+        """
+
+        config = self.get_config()
+
+        assert isinstance(username, basestring)
+
+        plugin_tag = get_plugin_tag(self)
+
+        if config.fast_soap:
+            with timed('soap', plugin=plugin_tag, path='fast'):
+                token = self._request_token_fast(username)
+
+            if token:
+                return token
+
+            logger.warning(
+                'Unexpected SOAP response requesting token for %s, '
+                'falling back to suds.', username
+            )
+
+        with timed('soap', plugin=plugin_tag, path='suds'):
+            return self.call_backend(
+                config.endpoint_url, self._request_token_suds, username
+            )
+
     def _get_cache_key(self, username):
         """ Return a sensible cache key for username. """
         return 'iprova_sso_{user}'.format(
             user=username
         )
 
+    def get_user_cache_keys(self, username):
+        """ Return cache key for the login token of a user. """
+
+        return [self._get_cache_key(username)]
+
     def _get_login_token(self, username):
         """ Return a valid (possibly cached) login token. """
 
-        settings = self.get_settings()
-
-        assert 'key_expiration' in settings
+        config = self.get_config()
 
         cache_key = self._get_cache_key(username)
-        cache_timeout = settings['key_expiration']
 
-        token = cache.get(cache_key)
-        if not token:
-            # Request a new token
-            token = self._request_token(username)
+        # Get token from cache, requesting and storing a new one if missing
+        tokens = self.get_or_mint_many(
+            cache, [cache_key],
+            lambda cache_keys: {cache_key: self._request_token(username)},
+            config.key_expiration, config.key_soft_expiration
+        )
+
+        token = tokens.get(cache_key)
 
-            cache.set(cache_key, token, cache_timeout)
+        if not token:
+            raise RequestKeyException('No token obtained for user.')
 
         return token
 
     def _generate_login_url(self, url, token):
         """ Generate a login URL using supplied token. """
 
-        settings = self.get_settings()
-        assert 'root_url' in settings
-        assert url.startswith(settings['root_url'])
+        assert url.startswith(self.get_config().root_url)
         assert '?' not in url
 
         return '{0}?token={1}'.format(url, token)
 
-    def get_login_urls(self, request):
-        """ Return login URL """
+    def _get_login_url_key(self, service):
+        """ Return context key for service, e.g. 'IPROVA_MANAGEMENT_SSO_URL' """
 
-        settings = self.get_settings()
-        assert 'root_url' in settings
-        assert 'services' in settings
+        return '{0}_{1}_SSO_URL'.format(
+            self.settings_name, service.upper()
+        )
+
+    def get_login_url_keys(self):
+        """ Return context keys for all configured services. """
+
+        return [service.context_key for service in self.get_config().services]
+
+    def get_login_url(self, request, service_name):
+        """
+        Return login URL for a single service, or None when the service is
+        not configured or the user has no access to it.
+        """
+
+        config = self.get_config()
+
+        services = [
+            service for service in config.services
+            if service.name == service_name
+        ]
+
+        if not services or not request.user.is_authenticated():
+            return None
+
+        if not config.has_access(request, service_name):
+            return None
+
+        token = self._get_login_token(request.user.username)
+
+        return self._generate_login_url(services[0].url, token)
 
-        # Method to determine access for request (user), service
-        has_access = settings.get(
-            'has_access', lambda request, service: True
+    def get_login_url_names(self, request):
+        """ Return names of services the user may access by context key. """
+
+        config = self.get_config()
+
+        if not request.user.is_authenticated():
+            return {}
+
+        return dict(
+            (service.context_key, service.name)
+            for service in config.services
+            if config.has_access(request, service.name)
         )
 
+    def prewarm(self, request):
+        """
+        Mint and cache the login token for the user of `request`, which is
+        shared by all services, when the user may access any of them.
+        """
+
+        if not self.get_login_url_names(request):
+            return []
+
+        try:
+            self._get_login_token(request.user.username)
+        except RequestKeyException, e:
+            return [e]
+
+        return []
+
+    def get_login_urls(self, request):
+        """ Return login URL """
+
+        config = self.get_config()
+
         login_urls = {}
 
         if request.user.is_authenticated():
@@ -141,9 +429,9 @@ class iProvaPlugin(SSOPluginBase):
             # users without permission
             token = None
 
-            for service in settings['services']:
+            for service in config.services:
                 # Determine whether user has access rights
-                if not has_access(request, service):
+                if not config.has_access(request, service.name):
                     # has_access(request) is defined and user does not have
                     # access to this site - skip.
                     continue
@@ -152,16 +440,8 @@ class iProvaPlugin(SSOPluginBase):
                     # Get token
                     token = self._get_login_token(request.user.username)
 
-                # Generate key, e.g. 'IPROVA_MANAGEMENT_SSO_URL'
-                url_key = '{0}_{1}_SSO_URL'.format(
-                    self.settings_name, service.upper()
-                )
-
-                url = '{0}{1}/'.format(
-                    settings['root_url'], service
-                )
-
-                login_urls[url_key] = self._generate_login_url(url, token)
+                login_urls[service.context_key] = \
+                    self._generate_login_url(service.url, token)
 
         return login_urls
 
@@ -19,6 +19,8 @@
 
 from django.conf import settings as django_settings
 from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.test.signals import setting_changed
 
 from .utils import SettingsBase, import_object
 
@@ -29,8 +31,151 @@ class UrlSSOSettings(SettingsBase):
 
     DEFAULT_REQUEST_TIMEOUT = 5
 
+    @property
+    def DEFAULT_CONNECT_TIMEOUT(self):
+        """ Seconds to wait for a connection, REQUEST_TIMEOUT by default. """
+        return self.REQUEST_TIMEOUT
+
+    @property
+    def DEFAULT_READ_TIMEOUT(self):
+        """ Seconds to wait for response data, REQUEST_TIMEOUT by default. """
+        return self.REQUEST_TIMEOUT
+
+    # Total seconds for all backend calls while rendering a request, or None
+    DEFAULT_BUDGET = None
+
+    # Call plugins concurrently when resolving all login URL's
+    DEFAULT_CONCURRENT = False
+
+    # Number of threads used for concurrent plugin calls
+    DEFAULT_MAX_WORKERS = 4
+
+    # Maximum time in seconds to wait for concurrent plugin calls, or None
+    DEFAULT_DEADLINE = None
+
+    # Seconds a worker may hold the lease for minting a key or token, None
+    # disables coordination between processes
+    DEFAULT_LEASE_TIMEOUT = 10
+
+    # Seconds to wait for a key or token minted by another process
+    DEFAULT_LEASE_WAIT = 5
+
+    # Mint login URL's in the background when users log in
+    DEFAULT_PREWARM = False
+
+    # Consecutive failures after which requests to a backend are refused,
+    # None disables circuit breakers
+    DEFAULT_CIRCUIT_BREAKER_THRESHOLD = None
+
+    # Seconds to refuse requests before trying a backend again
+    DEFAULT_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+    # Share circuit breaker state between processes through Django's cache
+    DEFAULT_CIRCUIT_BREAKER_SHARED = False
+
+    # Seconds to remember failures to obtain a key or token, by exception
+    # class import path; the closest base class listed applies
+    DEFAULT_ERROR_TIMEOUTS = {}
+
+    # Maximum number of keys and tokens kept in an in-process cache in front
+    # of Django's cache, None disables the in-process cache
+    DEFAULT_LOCAL_CACHE_ENTRIES = None
+
+    # Seconds to keep keys and tokens in the in-process cache, capped by the
+    # plugin's key expiration
+    DEFAULT_LOCAL_CACHE_TIMEOUT = 60
+
+    # Connection pools kept per backend host by each plugin's HTTP adapter,
+    # overridable with `pool_connections` in the plugin settings
+    DEFAULT_POOL_CONNECTIONS = 10
+
+    # Connections kept alive per backend host, `pool_maxsize` for plugins
+    DEFAULT_POOL_MAXSIZE = 10
+
+    # Wait for a free connection instead of opening (and discarding) extra
+    # connections when the pool is exhausted, `pool_block` for plugins
+    DEFAULT_POOL_BLOCK = False
+
+    # Reuse connections between requests, `keep_alive` for plugins
+    DEFAULT_KEEP_ALIVE = True
+
+    # Import path of the sink receiving metrics, see `url_sso.metrics`
+    DEFAULT_METRICS_SINK = 'url_sso.metrics.NullSink'
+
+    # Server and metric name prefix for `url_sso.metrics.StatsdSink`
+    DEFAULT_STATSD_HOST = 'localhost'
+    DEFAULT_STATSD_PORT = 8125
+    DEFAULT_STATSD_PREFIX = 'url_sso'
+
+    # Login URL's in the template context: 'direct' for SSO login URL's,
+    # 'redirect' for local URL's requesting keys only when followed or
+    # 'deferred' for just the URL of the JSON endpoint
+    DEFAULT_CONTEXT_MODE = 'direct'
+
+    # Seconds browsers may cache login URL's from the JSON endpoint
+    DEFAULT_JSON_MAX_AGE = 60
+
+    # Report SSO timings in a Server-Timing header, True for all responses
+    # or 'staff' for staff users only (requires ServerTimingMiddleware)
+    DEFAULT_SERVER_TIMING = False
+
+    # Resolved plugins and metrics sink, cleared by reset()
+    _plugins = None
+    _metrics = None
+
+    def reset(self):
+        """ Forget resolved settings, plugins and metrics sink. """
+
+        super(UrlSSOSettings, self).reset()
+
+        self._plugins = None
+        self._metrics = None
+
     @property
     def PLUGINS(self):
+        """
+        Return URL SSO plugins, importing them once and caching the result.
+        """
+
+        if self._plugins is None:
+            self._plugins = self._import_plugins()
+
+        return self._plugins
+
+    @property
+    def METRICS(self):
+        """
+        Return the metrics sink, instantiating it once and caching the
+        result.
+        """
+
+        if self._metrics is None:
+            try:
+                self._metrics = import_object(self.METRICS_SINK)()
+
+            except Exception as e:
+                raise ImproperlyConfigured(
+                    "Error while importing setting "
+                    "URL_SSO_METRICS_SINK %r: %s" % (self.METRICS_SINK, e)
+                )
+
+        return self._metrics
+
+    def get_plugin(self, name):
+        """
+        Return the enabled plugin named `name`, i.e. 'intershift' for the
+        plugin with settings name 'INTERSHIFT', or None if there is none.
+        """
+
+        for sso_plugin in self.PLUGINS:
+            settings_name = getattr(sso_plugin, 'settings_name', None)
+
+            if settings_name and settings_name.lower() == name.lower():
+                return sso_plugin
+
+        return None
+
+    def _import_plugins(self):
         """ Instantiate URL SSO plugins from import path. """
 
         url_sso_plugins = getattr(
@@ -54,3 +199,11 @@ class UrlSSOSettings(SettingsBase):
         return url_sso_plugins
 
 url_sso_settings = UrlSSOSettings()
+
+
+@receiver(setting_changed)
+def reset_settings(sender, setting, **kwargs):
+    """ Make sure changes to URL_SSO_* settings (i.e. in tests) apply. """
+
+    if setting.startswith(url_sso_settings.settings_prefix + '_'):
+        url_sso_settings.reset()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Signal receivers for django-url-sso. """
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.dispatch import receiver
+
+from .settings import url_sso_settings
+from .utils import get_thread_pool, call_in_thread
+from .plugins.base import get_local_cache
+
+
+def prewarm_plugin(sso_plugin, request):
+    """
+    Mint login URL's for the user of `request` with a single plugin,
+    logging failures as nobody waits for the result.
+    """
+
+    try:
+        errors = sso_plugin.prewarm(request)
+    except Exception:
+        logger.exception('Error prewarming login URL\'s with %s', sso_plugin)
+
+        return
+
+    for e in errors:
+        logger.error(
+            'Error prewarming login URL\'s with %s: %s', sso_plugin, e
+        )
+
+
+@receiver(user_logged_in)
+def prewarm_login_urls(sender, request, user, **kwargs):
+    """
+    When URL_SSO_PREWARM is set, mint login URL's for a user who just
+    logged in from background threads, such that the cache is warm by the
+    time the first page renders.
+    """
+
+    if not url_sso_settings.PREWARM:
+        return
+
+    pool = get_thread_pool('prewarm', url_sso_settings.MAX_WORKERS)
+
+    for sso_plugin in url_sso_settings.PLUGINS:
+        pool.apply_async(call_in_thread, (prewarm_plugin, sso_plugin, request))
+
+
+@receiver(user_logged_out)
+def invalidate_login_urls(sender, request, user, **kwargs):
+    """
+    Remove keys and tokens of a user who logged out from the in-process
+    cache. Django's cache is left alone, as other processes may still use
+    them.
+    """
+
+    if user is None or get_local_cache() is None:
+        return
+
+    for sso_plugin in url_sso_settings.PLUGINS:
+        sso_plugin.invalidate_local(
+            sso_plugin.get_user_cache_keys(user.username)
+        )
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Template tags for django-url-sso. """
+
+import logging
+logger = logging.getLogger(__name__)
+
+from django import template
+from django.utils.html import conditional_escape
+
+from url_sso.settings import url_sso_settings
+from url_sso.exceptions import RequestKeyException
+from url_sso.metrics import timed, increment, get_plugin_tag
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def sso_login_url(context, plugin_name, name):
+    """
+    Return the login URL for a single site or service, only requesting the
+    key for that site or service. Requires `request` in the template context
+    (`django.core.context_processors.request`).
+
+    Example::
+
+        {% load sso_tags %}
+        <a href="{% sso_login_url "intershift" "portal" %}">Portal</a>
+
+    Renders an empty string when the user has no access or the key could
+    not be obtained.
+    """
+
+    request = context.get('request')
+
+    if request is None:
+        logger.warning('No request in context for sso_login_url.')
+
+        return ''
+
+    sso_plugin = url_sso_settings.get_plugin(plugin_name)
+
+    if sso_plugin is None:
+        logger.warning('SSO plugin %s not enabled.', plugin_name)
+
+        return ''
+
+    plugin_tag = get_plugin_tag(sso_plugin)
+
+    with timed('login_urls', plugin=plugin_tag):
+        try:
+            login_url = sso_plugin.get_login_url(request, name)
+        except RequestKeyException:
+            # Log the stack trace but don't make rendering fail
+            logger.exception(
+                'Error requesting login key for %s %s', plugin_name, name
+            )
+
+            increment('login_urls.errors', plugin=plugin_tag)
+
+            return ''
+
+    return conditional_escape(login_url or '')
@@ -18,6 +18,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .context_processor import ContextProcessorTests
+from .management import PrewarmCommandTests
+from .metrics import MetricsTests
+from .middleware import ServerTimingMiddlewareTests
 from .plugins.base import BaseTests
 from .plugins.intershift import IntershiftTests
 from .plugins.iprova import iProvaTests
+from .views import LoginRedirectTests
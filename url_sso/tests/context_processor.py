@@ -19,11 +19,25 @@
 
 """ Common tests seperate from plugins. """
 
+import time
+import threading
+
+from mock import patch
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.template import Template, RequestContext
 from django.test import TestCase
 
 from url_sso.context_processors import login_urls
+from url_sso.settings import url_sso_settings
+from url_sso.signals import prewarm_plugin
+from url_sso.utils import get_thread_pool
 
-from .mock_plugins import mock_plugin_one
+from .mock_plugins import (
+    mock_plugin_one, mock_plugin_two, mock_plugin_counting,
+    mock_plugin_exception
+)
 
 from .utils import RequestTestMixin
 
@@ -78,3 +92,207 @@ class ContextProcessorTests(RequestTestMixin, TestCase):
                     'OTHER_URL': 'https://www.bogus.com/other_token'
                 }
             )
+
+    def test_lazy(self):
+        """ Test plugins are only called once their keys are used """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_one',
+            'url_sso.tests.mock_plugins.mock_plugin_counting'
+        ]
+
+        mock_plugin_counting.calls = 0
+
+        with self.settings(URL_SSO_PLUGINS=sso_plugins):
+            context = login_urls(self.request)
+
+            # Nothing resolved yet
+            self.assertEquals(mock_plugin_counting.calls, 0)
+
+            # Unknown keys should not resolve advertising plugins
+            self.assertEquals(
+                context['MY_URL'], 'https://www.bogus.com/some_token'
+            )
+            self.assertFalse('BANANA_URL' in context)
+            self.assertEquals(mock_plugin_counting.calls, 0)
+
+            # Advertised key resolves the plugin, only once
+            self.assertTrue('COUNTING_URL' in context)
+            self.assertEquals(
+                context['COUNTING_URL'],
+                'https://www.bogus.com/counting_token'
+            )
+            self.assertEquals(mock_plugin_counting.calls, 1)
+
+            self.assertEquals(len(context), 2)
+            self.assertEquals(mock_plugin_counting.calls, 1)
+
+    def test_lazy_template(self):
+        """ Test lazy resolution when rendering a template """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_counting'
+        ]
+
+        mock_plugin_counting.calls = 0
+
+        with self.settings(
+            URL_SSO_PLUGINS=sso_plugins,
+            TEMPLATE_CONTEXT_PROCESSORS=[
+                'url_sso.context_processors.login_urls'
+            ]
+        ):
+            # Template not using any login URL
+            Template('Hello').render(RequestContext(self.request))
+            self.assertEquals(mock_plugin_counting.calls, 0)
+
+            output = Template('{{ COUNTING_URL }}').render(
+                RequestContext(self.request)
+            )
+
+        self.assertEquals(output, 'https://www.bogus.com/counting_token')
+        self.assertEquals(mock_plugin_counting.calls, 1)
+
+    def test_concurrent(self):
+        """ Test calling plugins concurrently """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_slow',
+            'url_sso.tests.mock_plugins.mock_plugin_slower',
+            'url_sso.tests.mock_plugins.mock_plugin_exception'
+        ]
+
+        with self.settings(
+            URL_SSO_PLUGINS=sso_plugins, URL_SSO_CONCURRENT=True
+        ):
+            start = time.time()
+
+            self.assertEquals(login_urls(self.request), {
+                'SLOW_URL': 'https://www.bogus.com/slow_token',
+                'SLOWER_URL': 'https://www.bogus.com/slower_token'
+            })
+
+            # Plugins sleep 0.2s each; latency should be the max, not the sum
+            self.assertTrue(time.time() - start < 0.35)
+
+    def test_concurrent_busy_pool(self):
+        """ Test plugins queued behind other requests are called directly """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_slow',
+            'url_sso.tests.mock_plugins.mock_plugin_slower'
+        ]
+
+        blocker = threading.Event()
+
+        with self.settings(
+            URL_SSO_PLUGINS=sso_plugins,
+            URL_SSO_CONCURRENT=True,
+            URL_SSO_MAX_WORKERS=1,
+            URL_SSO_DEADLINE=1
+        ):
+            # Another request occupying the pool
+            get_thread_pool('plugins', 1).apply_async(blocker.wait, (5, ))
+
+            try:
+                start = time.time()
+
+                self.assertEquals(login_urls(self.request), {
+                    'SLOW_URL': 'https://www.bogus.com/slow_token',
+                    'SLOWER_URL': 'https://www.bogus.com/slower_token'
+                })
+
+                # No slower than calling plugins one by one
+                self.assertTrue(time.time() - start < 0.6)
+            finally:
+                blocker.set()
+
+    def test_concurrent_deadline(self):
+        """ Test plugins missing the deadline are dropped """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_one',
+            'url_sso.tests.mock_plugins.mock_plugin_slow'
+        ]
+
+        with self.settings(
+            URL_SSO_PLUGINS=sso_plugins,
+            URL_SSO_CONCURRENT=True,
+            URL_SSO_DEADLINE=0.05
+        ):
+            self.assertEquals(
+                login_urls(self.request),
+                mock_plugin_one.bogus_dict
+            )
+
+    def test_plugins_cached(self):
+        """ Test plugins are imported once and reset on setting changes """
+
+        with self.settings(
+            URL_SSO_PLUGINS=['url_sso.tests.mock_plugins.mock_plugin_one']
+        ):
+            plugins = url_sso_settings.PLUGINS
+            self.assertEquals(plugins, [mock_plugin_one])
+
+            # Same resolved list should be returned
+            self.assertTrue(url_sso_settings.PLUGINS is plugins)
+
+            with self.settings(
+                URL_SSO_PLUGINS=['url_sso.tests.mock_plugins.mock_plugin_two']
+            ):
+                self.assertEquals(url_sso_settings.PLUGINS, [mock_plugin_two])
+
+            self.assertEquals(url_sso_settings.PLUGINS, [mock_plugin_one])
+
+    def test_prewarm(self):
+        """ Test login URL's are minted in the background on login """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_counting'
+        ]
+
+        mock_plugin_counting.calls = 0
+
+        user = User.objects.create_user(username='john')
+
+        with self.settings(URL_SSO_PLUGINS=sso_plugins, URL_SSO_PREWARM=True):
+            user_logged_in.send(
+                sender=User, request=self.request, user=user
+            )
+
+            # Wait for background thread
+            for i in range(20):
+                if mock_plugin_counting.calls:
+                    break
+
+                time.sleep(0.05)
+
+        self.assertEquals(mock_plugin_counting.calls, 1)
+
+    @patch('url_sso.signals.logger')
+    def test_prewarm_error(self, mock_logger):
+        """ Test errors minting login URL's in the background are logged """
+
+        self.request.user = User.objects.create_user(username='john')
+
+        with patch.object(
+            mock_plugin_counting, 'prewarm', side_effect=ValueError
+        ):
+            prewarm_plugin(mock_plugin_counting, self.request)
+
+        self.assertTrue(mock_logger.exception.called)
+
+        # Failing login URL's are logged as well
+        prewarm_plugin(mock_plugin_exception, self.request)
+
+        self.assertTrue(mock_logger.error.called)
+
+    @patch('url_sso.signals.get_thread_pool')
+    def test_prewarm_disabled(self, mock_method):
+        """ Test nothing is scheduled on login by default """
+
+        user = User.objects.create_user(username='john')
+
+        user_logged_in.send(sender=User, request=self.request, user=user)
+
+        self.assertFalse(mock_method.called)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests for management commands. """
+
+import time
+
+from StringIO import StringIO
+
+from mock import patch
+from httmock import HTTMock
+
+from django.contrib.auth.models import User
+from django.core import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from url_sso.utils import RateLimiter
+from url_sso.plugins import intershift
+
+from .mock_plugins import mock_plugin_counting
+from .plugins.intershift import intershift_settings
+
+
+class PrewarmCommandTests(TestCase):
+    """ Tests for the url_sso_prewarm management command """
+
+    def setUp(self):
+        self.john = User.objects.create_user(username='john')
+        self.paul = User.objects.create_user(username='paul')
+        self.ringo = User.objects.create_user(username='ringo')
+
+        self.ringo.is_active = False
+        self.ringo.save()
+
+        mock_plugin_counting.calls = 0
+
+    def call_command(self, *args, **options):
+        """ Call command, returning stdout and stderr. """
+
+        stdout = StringIO()
+        stderr = StringIO()
+
+        call_command(
+            'url_sso_prewarm', *args, stdout=stdout, stderr=stderr, **options
+        )
+
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_usernames(self):
+        """ Test prewarming users given as arguments """
+
+        sso_plugins = ['url_sso.tests.mock_plugins.mock_plugin_counting']
+
+        with self.settings(URL_SSO_PLUGINS=sso_plugins):
+            stdout, stderr = self.call_command('john', 'paul', 'george')
+
+        self.assertEquals(mock_plugin_counting.calls, 2)
+        self.assertTrue('Prewarmed 2 users' in stdout)
+        self.assertTrue('0 errors' in stdout)
+        self.assertEquals(stderr, 'Unknown user: george\n')
+
+    def test_stdin(self):
+        """ Test reading usernames from stdin """
+
+        sso_plugins = ['url_sso.tests.mock_plugins.mock_plugin_counting']
+
+        with self.settings(URL_SSO_PLUGINS=sso_plugins):
+            with patch('sys.stdin', StringIO('john\n\npaul\n')):
+                stdout, stderr = self.call_command()
+
+        self.assertEquals(mock_plugin_counting.calls, 2)
+        self.assertTrue('Prewarmed 2 users' in stdout)
+
+    def test_filter(self):
+        """ Test selecting users with filters """
+
+        sso_plugins = [
+            'url_sso.tests.mock_plugins.mock_plugin_counting',
+            'url_sso.tests.mock_plugins.mock_plugin_exception'
+        ]
+
+        with self.settings(URL_SSO_PLUGINS=sso_plugins):
+            stdout, stderr = self.call_command(
+                filters=['is_active=True'], workers=2, progress=1
+            )
+
+        self.assertEquals(mock_plugin_counting.calls, 2)
+        self.assertTrue('Prewarmed 1 users' in stdout)
+        self.assertTrue('Prewarmed 2 users' in stdout)
+        self.assertTrue('2 errors' in stdout)
+
+    def test_backend_errors(self):
+        """ Test each failing login URL is counted as an error """
+
+        locmem_cache = cache.get_cache(
+            'django.core.cache.backends.locmem.LocMemCache'
+        )
+        locmem_cache.clear()
+
+        requests = []
+
+        def error_mock(url, request):
+            requests.append(url)
+
+            return {'status_code': 500, 'content': ''}
+
+        with self.settings(
+            URL_SSO_PLUGINS=['url_sso.plugins.intershift.intershift_plugin'],
+            URL_SSO_INTERSHIFT=intershift_settings
+        ):
+            with patch.object(intershift, 'cache', locmem_cache):
+                with HTTMock(error_mock):
+                    stdout, stderr = self.call_command('john', 'paul')
+
+        # Users have no access to site1, site2 and site3 fail for both
+        self.assertEquals(len(requests), 4)
+        self.assertTrue('Prewarmed 2 users' in stdout)
+        self.assertTrue('4 errors' in stdout)
+
+    def test_rate(self):
+        """ Test requests to a backend are rate limited """
+
+        locmem_cache = cache.get_cache(
+            'django.core.cache.backends.locmem.LocMemCache'
+        )
+        locmem_cache.clear()
+
+        requests = []
+
+        def key_mock(url, request):
+            requests.append(time.time())
+
+            return '<xml><key value="BOGUSKEY" /></xml>'
+
+        with self.settings(
+            URL_SSO_PLUGINS=['url_sso.plugins.intershift.intershift_plugin'],
+            URL_SSO_INTERSHIFT=intershift_settings
+        ):
+            with patch.object(intershift, 'cache', locmem_cache):
+                with HTTMock(key_mock):
+                    stdout, stderr = self.call_command(
+                        'john', 'paul', workers=2, rate=20
+                    )
+
+        # Two sites for two users, all on the same backend
+        self.assertEquals(len(requests), 4)
+        self.assertTrue(max(requests) - min(requests) >= 0.14)
+        self.assertTrue('0 errors' in stdout)
+
+    def test_rate_limiter(self):
+        """ Test RateLimiter spaces calls """
+
+        rate_limiter = RateLimiter(20)
+
+        start = time.time()
+        for i in range(5):
+            rate_limiter.wait()
+
+        # First call passes immediately, others wait 1/20s each
+        self.assertTrue(time.time() - start >= 0.19)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests for metrics sinks and instrumentation helpers. """
+
+import socket
+
+from mock import patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from url_sso import metrics
+from url_sso.context_processors import get_plugin_login_urls
+from url_sso.metrics import (
+    StatsdSink, LoggingSink, ServerTimings, timed, tagged, increment,
+    collect_server_timings
+)
+from url_sso.settings import url_sso_settings
+
+from .mock_plugins import mock_plugin_one, mock_plugin_exception
+from .utils import RequestTestMixin
+
+
+class MetricsTests(RequestTestMixin, TestCase):
+    """ Tests for url_sso.metrics """
+
+    def test_disabled(self):
+        """ Test nothing is collected by default """
+
+        self.assertFalse(url_sso_settings.METRICS.enabled)
+
+        self.assertTrue(timed('backend') is metrics._null_timer)
+        self.assertTrue(tagged(site='site1') is metrics._null_timer)
+
+    @override_settings(
+        URL_SSO_METRICS_SINK='url_sso.tests.utils.RecordingSink'
+    )
+    def test_timed_tagged(self):
+        """ Test timings, error counts and thread tags """
+
+        sink = url_sso_settings.METRICS
+
+        with tagged(site='site1'):
+            with timed('backend', plugin='one'):
+                pass
+
+            try:
+                with timed('backend', plugin='one'):
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        increment('backend.calls', plugin='one')
+
+        tags = {'plugin': 'one', 'site': 'site1'}
+
+        self.assertEquals(sink.records, [
+            ('timing', 'backend', tags),
+            ('timing', 'backend', tags),
+            ('increment', 'backend.errors', 1, tags),
+            ('increment', 'backend.calls', 1, {'plugin': 'one'})
+        ])
+
+    @override_settings(
+        URL_SSO_METRICS_SINK='url_sso.tests.utils.RecordingSink'
+    )
+    def test_login_urls(self):
+        """ Test plugin calls are timed and failures counted """
+
+        sink = url_sso_settings.METRICS
+
+        get_plugin_login_urls(mock_plugin_one, self.request)
+        get_plugin_login_urls(mock_plugin_exception, self.request)
+
+        self.assertEquals(sink.records, [
+            ('timing', 'login_urls', {'plugin': 'one'}),
+            ('increment', 'login_urls.errors', 1, {'plugin': 'exception'}),
+            ('timing', 'login_urls', {'plugin': 'exception'})
+        ])
+
+    def test_server_timings(self):
+        """ Test durations are collected per plugin and for the cache """
+
+        server_timings = ServerTimings()
+
+        with collect_server_timings(server_timings):
+            for tier in ('local', 'shared'):
+                with timed('cache', plugin='intershift', tier=tier):
+                    pass
+
+            with timed('login_urls', plugin='intershift'):
+                pass
+
+            # Not reported
+            with timed('backend', plugin='intershift'):
+                pass
+
+        self.assertEquals(
+            sorted(server_timings.durations.keys()),
+            ['sso-cache', 'sso-intershift']
+        )
+
+        # Metrics are not collected for sinks while disabled
+        self.assertTrue(timed('backend') is metrics._null_timer)
+
+    def test_statsd_sink(self):
+        """ Test metrics are sent to statsd in the DogStatsD format """
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+
+        try:
+            sink = StatsdSink(
+                host='127.0.0.1', port=server.getsockname()[1], prefix='sso'
+            )
+
+            sink.timing('backend', 42, {'plugin': 'iprova', 'path': 'fast'})
+            self.assertEquals(
+                server.recv(1024),
+                'sso.backend:42.00|ms|#path:fast,plugin:iprova'
+            )
+
+            sink.increment('cache.hits', 3, {})
+            self.assertEquals(server.recv(1024), 'sso.cache.hits:3|c')
+
+        finally:
+            server.close()
+
+    def test_logging_sink(self):
+        """ Test metrics are logged """
+
+        sink = LoggingSink()
+
+        with patch.object(metrics.logger, 'info') as mock_info:
+            sink.increment('backend.calls', 1, {'plugin': 'intershift'})
+
+        mock_info.assert_called_once_with(
+            '%s +%d %s', 'backend.calls', 1, 'plugin=intershift'
+        )
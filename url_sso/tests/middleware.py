@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests for middleware. """
+
+import re
+
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from url_sso.context_processors import login_urls
+from url_sso.metrics import get_server_timings
+from url_sso.middleware import ServerTimingMiddleware
+
+from .utils import RequestTestMixin
+
+
+@override_settings(URL_SSO_PLUGINS=[
+    'url_sso.tests.mock_plugins.mock_plugin_one',
+    'url_sso.tests.mock_plugins.mock_plugin_two'
+])
+class ServerTimingMiddlewareTests(RequestTestMixin, TestCase):
+    """ Tests for ServerTimingMiddleware """
+
+    def setUp(self):
+        super(ServerTimingMiddlewareTests, self).setUp()
+
+        self.middleware = ServerTimingMiddleware()
+
+        self.request.user = User(username='john')
+
+    def get_response(self, response=None):
+        """ Run middleware around resolving all login URL's. """
+
+        self.middleware.process_request(self.request)
+
+        dict(login_urls(self.request))
+
+        return self.middleware.process_response(
+            self.request, response or HttpResponse()
+        )
+
+    def assertTimings(self, header, metrics):
+        """ Assert header reports durations for `metrics` in order. """
+
+        self.assertEquals(re.findall(r'([\w-]+);dur=[\d.]+', header), metrics)
+
+    @override_settings(URL_SSO_SERVER_TIMING=True)
+    def test_server_timing(self):
+        """ Test durations per plugin are reported """
+
+        response = self.get_response()
+
+        self.assertTimings(response['Server-Timing'], ['sso-one', 'sso-two'])
+
+        # Collection stops with the response
+        self.assertEquals(get_server_timings(), None)
+
+    @override_settings(URL_SSO_SERVER_TIMING=True, URL_SSO_CONCURRENT=True)
+    def test_server_timing_concurrent(self):
+        """ Test durations are collected from pool threads """
+
+        response = self.get_response()
+
+        self.assertTimings(response['Server-Timing'], ['sso-one', 'sso-two'])
+
+    @override_settings(URL_SSO_SERVER_TIMING=True)
+    def test_server_timing_existing(self):
+        """ Test durations are appended to an existing header """
+
+        response = HttpResponse()
+        response['Server-Timing'] = 'db;dur=3'
+
+        response = self.get_response(response)
+
+        self.assertTimings(
+            response['Server-Timing'], ['db', 'sso-one', 'sso-two']
+        )
+
+    def test_server_timing_disabled(self):
+        """ Test no header is added by default """
+
+        response = self.get_response()
+
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(URL_SSO_SERVER_TIMING='staff')
+    def test_server_timing_staff(self):
+        """ Test the header is only added for staff users """
+
+        response = self.get_response()
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        self.request.user.is_staff = True
+
+        response = self.get_response()
+        self.assertTrue(response.has_header('Server-Timing'))
@@ -19,6 +19,8 @@
 
 """ Mock plugins used for testing. """
 
+import time
+
 from url_sso.exceptions import RequestKeyException
 from url_sso.plugins.base import SSOPluginBase
 
@@ -52,7 +54,54 @@ class MockPluginTwo(SSOPluginBase):
         return self.bogus_dict
 
 
+class MockPluginCounting(SSOPluginBase):
+    """ Plugin advertising its keys and counting calls. """
+    settings_name = 'COUNTING'
+
+    calls = 0
+
+    bogus_dict = {
+        'COUNTING_URL': 'https://www.bogus.com/counting_token'
+    }
+
+    def get_login_url_keys(self):
+        return self.bogus_dict.keys()
+
+    def get_login_urls(self, request):
+        self.calls += 1
+
+        return self.bogus_dict
+
+
+class MockPluginSlow(SSOPluginBase):
+    """ Plugin taking `delay` seconds to return. """
+    settings_name = 'SLOW'
+
+    delay = 0.2
+
+    bogus_dict = {
+        'SLOW_URL': 'https://www.bogus.com/slow_token'
+    }
+
+    def get_login_urls(self, request):
+        time.sleep(self.delay)
+
+        return self.bogus_dict
+
+
+class MockPluginSlower(MockPluginSlow):
+    """ Second slow plugin, with its own key. """
+    settings_name = 'SLOWER'
+
+    bogus_dict = {
+        'SLOWER_URL': 'https://www.bogus.com/slower_token'
+    }
+
+
 # Instantiate singletons
 mock_plugin_one = MockPluginOne()
 mock_plugin_exception = MockPluginException()
 mock_plugin_two = MockPluginTwo()
+mock_plugin_counting = MockPluginCounting()
+mock_plugin_slow = MockPluginSlow()
+mock_plugin_slower = MockPluginSlower()
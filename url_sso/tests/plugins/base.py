@@ -17,14 +17,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+import threading
+
 from httmock import HTTMock
 
+from django.core import cache
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from ..mock_plugins import mock_plugin_one
+from ..utils import SlowServer
 
-from url_sso.exceptions import RequestKeyException
+from url_sso.exceptions import (
+    RequestKeyException, CircuitOpenException, BudgetExhaustedException,
+    InvalidResponseException
+)
+from url_sso.utils import (
+    CircuitBreaker, LocalCache, SingleFlight, use_deadline
+)
 
 
 class BaseTests(TestCase):
@@ -38,6 +49,19 @@ class BaseTests(TestCase):
 
         self.assertEquals(settings, {'TEST': True})
 
+    def test_get_config(self):
+        """ Test get_config() is compiled once per settings change """
+
+        with override_settings(URL_SSO_ONE={'TEST': True}):
+            config = mock_plugin_one.get_config()
+            self.assertEquals(config, {'TEST': True})
+
+            # Compiled configuration should be reused
+            self.assertTrue(mock_plugin_one.get_config() is config)
+
+        with override_settings(URL_SSO_ONE={'TEST': False}):
+            self.assertEquals(mock_plugin_one.get_config(), {'TEST': False})
+
     def test_get_url(self):
         """ Test get_url() """
 
@@ -58,3 +82,314 @@ class BaseTests(TestCase):
             RequestKeyException,
             lambda: mock_plugin_one.get_url('https://weirddomainnamethatdoesnotexist3423423432.com/')
         )
+
+    @override_settings(
+        URL_SSO_CIRCUIT_BREAKER_THRESHOLD=2,
+        URL_SSO_CIRCUIT_BREAKER_RESET_TIMEOUT=0.1
+    )
+    def test_get_url_circuit_breaker(self):
+        """ Test get_url() refuses requests to failing backends """
+
+        requests = []
+
+        def error_mock(url, request):
+            requests.append(url)
+
+            return {'status_code': 500}
+
+        with HTTMock(error_mock):
+            # Server errors are returned, opening the breaker
+            for i in range(2):
+                r = mock_plugin_one.get_url('https://www.bogus.com/')
+                self.assertEquals(r.status_code, 500)
+
+            # Open breaker fails without sending out a request
+            self.assertRaises(
+                CircuitOpenException,
+                lambda: mock_plugin_one.get_url('https://www.bogus.com/path')
+            )
+            self.assertEquals(len(requests), 2)
+
+        # Other backends are not affected
+        with HTTMock(lambda url, request: 'success'):
+            r = mock_plugin_one.get_url('https://www.other.com/')
+            self.assertEquals(r.status_code, 200)
+
+        # Half-open after reset timeout; a successful trial closes it
+        time.sleep(0.1)
+
+        with HTTMock(lambda url, request: 'success'):
+            for i in range(3):
+                r = mock_plugin_one.get_url('https://www.bogus.com/')
+                self.assertEquals(r.status_code, 200)
+
+    @override_settings(
+        URL_SSO_CIRCUIT_BREAKER_THRESHOLD=1,
+        URL_SSO_CIRCUIT_BREAKER_RESET_TIMEOUT=0.1
+    )
+    def test_call_backend_budget_trial(self):
+        """ Test an exhausted budget releases the half-open trial """
+
+        url = 'https://www.budget.com/'
+
+        def fail():
+            raise RequestKeyException()
+
+        def exhausted():
+            raise BudgetExhaustedException()
+
+        self.assertRaises(
+            RequestKeyException,
+            lambda: mock_plugin_one.call_backend(url, fail)
+        )
+
+        # Half-open; the trial ends without an answer from the backend
+        time.sleep(0.1)
+
+        self.assertRaises(
+            BudgetExhaustedException,
+            lambda: mock_plugin_one.call_backend(url, exhausted)
+        )
+
+        # Another trial is allowed, closing the breaker
+        self.assertEquals(mock_plugin_one.call_backend(url, lambda: 42), 42)
+
+        # No trial is taken once the budget is exhausted
+        with use_deadline(time.time() - 1):
+            self.assertRaises(
+                BudgetExhaustedException,
+                lambda: mock_plugin_one.call_backend(url, lambda: 42)
+            )
+
+    def test_single_flight_deadline(self):
+        """ Test waiting for another thread is limited by the deadline """
+
+        locmem_cache = cache.get_cache(
+            'django.core.cache.backends.locmem.LocMemCache'
+        )
+        locmem_cache.clear()
+
+        single_flight = SingleFlight()
+
+        def slow_mint(keys):
+            time.sleep(0.5)
+
+            return dict.fromkeys(keys, 'value')
+
+        # Leading thread without a deadline, i.e. prewarming
+        thread = threading.Thread(
+            target=single_flight.mint_many,
+            args=(locmem_cache, ['key'], slow_mint, 60)
+        )
+        thread.start()
+
+        time.sleep(0.05)
+
+        start = time.time()
+
+        with use_deadline(time.time() + 0.1):
+            self.assertRaises(
+                BudgetExhaustedException,
+                single_flight.mint_many, locmem_cache, ['key'], slow_mint, 60
+            )
+
+        self.assertTrue(time.time() - start < 0.3)
+
+        thread.join()
+
+    def test_circuit_breaker_states(self):
+        """ Test CircuitBreaker state transitions """
+
+        circuit_breaker = CircuitBreaker('test', 2, 0.1)
+
+        self.assertEquals(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+
+        circuit_breaker.record_failure()
+        self.assertEquals(circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(circuit_breaker.allow())
+
+        time.sleep(0.1)
+        self.assertEquals(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+
+        # Only a single trial call is allowed
+        self.assertTrue(circuit_breaker.allow())
+        self.assertFalse(circuit_breaker.allow())
+
+        # Failing trial opens the breaker again
+        circuit_breaker.record_failure()
+        self.assertEquals(circuit_breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.1)
+        self.assertTrue(circuit_breaker.allow())
+
+        circuit_breaker.record_success()
+        self.assertEquals(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_shared(self):
+        """ Test sharing CircuitBreaker state through the cache """
+
+        locmem_cache = cache.get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        locmem_cache.clear()
+
+        # Breakers in different processes, sharing a cache
+        circuit_breaker = CircuitBreaker('test', 1, 10, locmem_cache)
+        other_breaker = CircuitBreaker('test', 1, 10, locmem_cache)
+
+        circuit_breaker.record_failure()
+
+        self.assertEquals(other_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(other_breaker.allow())
+
+    @override_settings(URL_SSO_READ_TIMEOUT=0.1)
+    def test_get_url_read_timeout(self):
+        """ Test get_url() gives up on slow backends """
+
+        server = SlowServer(delay=0.5)
+        server.start()
+
+        try:
+            start = time.time()
+
+            self.assertRaises(
+                RequestKeyException,
+                lambda: mock_plugin_one.get_url(server.url)
+            )
+
+            self.assertTrue(time.time() - start < 0.4)
+
+        finally:
+            server.stop()
+
+    def test_get_url_budget(self):
+        """ Test get_url() timeouts shrink with the latency budget """
+
+        server = SlowServer(delay=0.2, body='success')
+        server.start()
+
+        try:
+            with use_deadline(time.time() + 0.3):
+                # Completes within the budget
+                r = mock_plugin_one.get_url(server.url)
+                self.assertEquals(r.content, 'success')
+
+                # Only ~0.1s left, should time out
+                start = time.time()
+
+                self.assertRaises(
+                    RequestKeyException,
+                    lambda: mock_plugin_one.get_url(server.url)
+                )
+
+                self.assertTrue(time.time() - start < 0.2)
+
+                # Budget is exhausted now
+                self.assertRaises(
+                    BudgetExhaustedException,
+                    lambda: mock_plugin_one.get_url(server.url)
+                )
+
+            # Outside of the budget requests work as usual
+            r = mock_plugin_one.get_url(server.url)
+            self.assertEquals(r.content, 'success')
+
+        finally:
+            server.stop()
+
+    def test_session_per_thread(self):
+        """ Test threads get their own session sharing one adapter """
+
+        session = mock_plugin_one.session
+
+        # Reused within a thread
+        self.assertTrue(mock_plugin_one.session is session)
+
+        sessions = []
+        thread = threading.Thread(
+            target=lambda: sessions.append(mock_plugin_one.session)
+        )
+        thread.start()
+        thread.join()
+
+        self.assertFalse(sessions[0] is session)
+
+        # Connection pool is shared
+        self.assertTrue(
+            sessions[0].get_adapter('https://www.bogus.com/') is
+            session.get_adapter('https://www.bogus.com/')
+        )
+
+    def test_session_pool_settings(self):
+        """ Test connection pool settings, globally and per plugin """
+
+        with override_settings(URL_SSO_POOL_MAXSIZE=20):
+            adapter = mock_plugin_one.session.get_adapter('https://x.com/')
+
+            self.assertEquals(adapter._pool_maxsize, 20)
+            self.assertEquals(adapter._pool_block, False)
+
+        with override_settings(URL_SSO_ONE={
+            'pool_maxsize': 5, 'pool_block': True, 'keep_alive': False
+        }):
+            session = mock_plugin_one.session
+            adapter = session.get_adapter('https://x.com/')
+
+            self.assertEquals(adapter._pool_maxsize, 5)
+            self.assertEquals(adapter._pool_block, True)
+            self.assertEquals(session.headers['Connection'], 'close')
+
+        # Defaults are restored
+        session = mock_plugin_one.session
+        adapter = session.get_adapter('https://x.com/')
+
+        self.assertEquals(adapter._pool_maxsize, 10)
+        self.assertNotEquals(session.headers.get('Connection'), 'close')
+
+    @override_settings(URL_SSO_ERROR_TIMEOUTS={
+        'url_sso.exceptions.RequestKeyException': 60,
+        'url_sso.exceptions.InvalidResponseException': 10
+    })
+    def test_get_error_timeout(self):
+        """ Test error timeouts by (closest base) exception class """
+
+        get_error_timeout = mock_plugin_one.get_error_timeout
+
+        self.assertEquals(get_error_timeout(RequestKeyException()), 60)
+        self.assertEquals(get_error_timeout(InvalidResponseException()), 10)
+        self.assertEquals(get_error_timeout(ValueError()), None)
+
+        # Not specific to the key requested
+        self.assertEquals(get_error_timeout(CircuitOpenException()), None)
+        self.assertEquals(get_error_timeout(BudgetExhaustedException()), None)
+
+    def test_local_cache(self):
+        """ Test LRU eviction, expiry and counters of LocalCache """
+
+        local_cache = LocalCache(max_entries=2)
+
+        local_cache.set('a', 1, 10)
+        local_cache.set('b', 2, 10)
+
+        # Use 'a', such that 'b' is least recently used
+        self.assertEquals(local_cache.get_many(['a']), {'a': 1})
+
+        local_cache.set('c', 3, 10)
+
+        self.assertEquals(
+            local_cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3}
+        )
+        self.assertEquals(local_cache.stats.as_dict(), {
+            'hits': 3, 'misses': 1
+        })
+
+        # Expired entries are not returned
+        local_cache.set('a', 1, 0.05)
+        time.sleep(0.1)
+
+        self.assertEquals(local_cache.get_many(['a']), {})
+
+        local_cache.delete_many(['c'])
+        self.assertEquals(len(local_cache), 0)
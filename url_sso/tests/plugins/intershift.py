@@ -17,19 +17,29 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
+import threading
+
+from lxml import etree
 from mock import patch
 from httmock import urlmatch, HTTMock
 
 from django.core import cache
 
+from django.contrib.auth.signals import user_logged_out
+from django.template import Template, Context
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from url_sso.context_processors import login_urls
-from url_sso.tests.utils import RequestTestMixin, UserTestMixin
+from url_sso.tests.utils import RequestTestMixin, UserTestMixin, SlowServer
 from url_sso.exceptions import RequestKeyException
+from url_sso.utils import use_deadline
 
+from url_sso.settings import url_sso_settings
 from url_sso.plugins import intershift
+from url_sso.plugins.base import get_local_cache, get_cache_stats
 from url_sso.plugins.intershift import intershift_plugin
 
 
@@ -95,6 +105,32 @@ class IntershiftTests(RequestTestMixin, UserTestMixin, TestCase):
     def tearDown(self):
         self.cache_patch.stop()
 
+    def test_compile_settings(self):
+        """ Test compile_settings() """
+
+        config = intershift_plugin.get_config()
+
+        self.assertEquals(config.secret, intershift_settings['secret'])
+        self.assertEquals(config.site_names, ['site1', 'site2', 'site3'])
+        self.assertEquals(
+            config.sites['site2'].context_key, 'INTERSHIFT_SITE2_SSO_URL'
+        )
+        self.assertEquals(
+            config.sites['site2'].url,
+            intershift_settings['sites']['site2']['url']
+        )
+
+        # Missing site URL's should be caught when compiling
+        invalid_settings = {
+            'secret': '12345678',
+            'key_expiration': 86400,
+            'sites': {'site1': {}}
+        }
+        self.assertRaises(
+            AssertionError,
+            lambda: intershift_plugin.compile_settings(invalid_settings)
+        )
+
     def test_get_site_url(self):
         """ Test _get_site_url() """
 
@@ -130,6 +166,52 @@ class IntershiftTests(RequestTestMixin, UserTestMixin, TestCase):
             lambda: intershift_plugin._parse_login_key(empty_key)
         )
 
+    def test_parse_login_key_fixtures(self):
+        """ Test scanning and parsing keys agree on (broken) responses """
+
+        directory = os.path.join(os.path.dirname(__file__), '..', 'data')
+
+        for filename, key in (
+            ('intershift_key_response.xml', 'BOGUSKEY'),
+            ('intershift_key_response_broken.xml', 'BOGUS&KEY')
+        ):
+            data = open(os.path.join(directory, filename)).read()
+
+            self.assertEquals(intershift_plugin._scan_login_key(data), key)
+            self.assertEquals(intershift_plugin._parse_login_key(data), key)
+
+            # Same result as the parser with recovery
+            root = etree.fromstring(data, etree.XMLParser(recover=True))
+            self.assertEquals(root.find('key').get('value'), key)
+
+        # Responses which can't be scanned are left to the parser
+        for data, key in (
+            ('<xml><key value="A&#38;B" /></xml>', 'A&B'),
+            ('<xml><!-- <key value="OLD" /> --><key value="NEW" /></xml>',
+             'NEW'),
+            ('<xml><key data-value="X" value="Y" /></xml>', 'Y')
+        ):
+            self.assertTrue(
+                intershift_plugin._scan_login_key(data) in (None, key)
+            )
+            self.assertEquals(intershift_plugin._parse_login_key(data), key)
+
+            root = etree.fromstring(data, etree.XMLParser(recover=True))
+            self.assertEquals(root.find('key').get('value'), key)
+
+    def test_parse_login_key_fallback(self):
+        """ Test the parser is used when scanning finds no key """
+
+        self.assertEquals(intershift_plugin._scan_login_key('banana'), None)
+
+        with patch.object(
+            intershift_plugin, '_scan_login_key', return_value=None
+        ) as scan_login_key:
+            login_key = intershift_plugin._parse_login_key(self.test_xml)
+
+        self.assertTrue(scan_login_key.called)
+        self.assertEquals(login_key, self.test_key)
+
     def test_request_login_key(self):
         """ Test _request_login_key() """
 
@@ -271,3 +353,620 @@ class IntershiftTests(RequestTestMixin, UserTestMixin, TestCase):
                 context,
                 self.test_login_urls
             )
+
+    def test_get_login_urls_failing_site(self):
+        """ Test a failing site does not discard other sites """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        @urlmatch(path='/site2/cust/singlesignon.asp')
+        def error_mock(url, request):
+            return {'status_code': 500}
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with HTTMock(error_mock, key_mock):
+            urls = intershift_plugin.get_login_urls(self.request)
+
+        self.assertEquals(urls, {
+            'INTERSHIFT_SITE3_SSO_URL':
+                self.test_login_urls['INTERSHIFT_SITE3_SSO_URL']
+        })
+
+    @override_settings(URL_SSO_ERROR_TIMEOUTS={
+        'url_sso.exceptions.RequestKeyException': 60
+    })
+    def test_get_login_urls_negative_cache(self):
+        """ Test failing sites are skipped while their error is cached """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        requests = []
+
+        @urlmatch(path='/site2/cust/singlesignon.asp')
+        def error_mock(url, request):
+            requests.append(url)
+
+            return {'status_code': 500}
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with HTTMock(error_mock, key_mock):
+            intershift_plugin.get_login_urls(self.request)
+
+            urls = intershift_plugin.get_login_urls(self.request)
+
+        # The failing site is only requested once
+        self.assertEquals(len(requests), 1)
+        self.assertEquals(urls, {
+            'INTERSHIFT_SITE3_SSO_URL':
+                self.test_login_urls['INTERSHIFT_SITE3_SSO_URL']
+        })
+
+        self.assertEquals(
+            self.locmem_cache.get('intershift_sso_site2_john_error'),
+            'InvalidResponseException: Request returned an error status.'
+        )
+
+    @override_settings(URL_SSO_ERROR_TIMEOUTS={
+        'url_sso.exceptions.RequestKeyException': 60,
+        'url_sso.exceptions.InvalidResponseException': 0
+    })
+    def test_generate_login_url_negative_cache(self):
+        """ Test error timeouts apply by exception class """
+
+        requests = []
+
+        def error_mock(url, request):
+            requests.append(url)
+
+            return 'banana'
+
+        with HTTMock(error_mock):
+            for attempt in range(2):
+                self.assertRaises(
+                    RequestKeyException,
+                    lambda: intershift_plugin._generate_login_url(
+                        'site1', self.user.username
+                    )
+                )
+
+        # Invalid responses are not remembered
+        self.assertEquals(len(requests), 2)
+
+        def fail_mock(url, request):
+            self.fail('Request should not be fired for a cached error.')
+
+        # Remember a connection error
+        self.locmem_cache.set(
+            'intershift_sso_site1_john_error', 'RequestKeyException: Down'
+        )
+
+        with HTTMock(fail_mock):
+            self.assertRaises(
+                RequestKeyException,
+                lambda: intershift_plugin._generate_login_url(
+                    'site1', self.user.username
+                )
+            )
+
+    @override_settings(URL_SSO_LOCAL_CACHE_ENTRIES=100)
+    def test_generate_login_url_local_cache(self):
+        """ Test the in-process cache tier in front of the shared cache """
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with HTTMock(key_mock):
+            intershift_plugin._generate_login_url('site1', self.user.username)
+
+        with patch.object(
+            self.locmem_cache, 'get_many', wraps=self.locmem_cache.get_many
+        ) as get_many:
+            login_url = intershift_plugin._generate_login_url(
+                'site1', self.user.username
+            )
+
+        self.assertEquals(login_url, self.test_login_url)
+
+        # Served from the in-process cache
+        self.assertFalse(get_many.called)
+
+        stats = get_cache_stats()
+        self.assertEquals(stats['local'], {'hits': 1, 'misses': 1})
+        self.assertTrue(stats['shared']['misses'] >= 1)
+
+        # Logging out drops the user's URL's from the in-process cache
+        user_logged_out.send(
+            sender=self.user.__class__, request=self.request, user=self.user
+        )
+
+        self.assertEquals(
+            get_local_cache().get_many(['intershift_sso_site1_john']), {}
+        )
+
+        # But stay in the shared cache
+        self.assertEquals(
+            self.locmem_cache.get('intershift_sso_site1_john')[0],
+            self.test_login_url
+        )
+
+    @override_settings(URL_SSO_LOCAL_CACHE_ENTRIES=100)
+    def test_generate_login_url_local_cache_expiry(self):
+        """ Test in-process entries never outlive the shared entry """
+
+        # Shared entry about to expire, without a soft expiry
+        self.locmem_cache.set(
+            'intershift_sso_site1_john',
+            (self.test_login_url, None, time.time() + 0.1)
+        )
+
+        def fail_mock(url, request):
+            self.fail('Request should not be fired when using cache.')
+
+        with HTTMock(fail_mock):
+            login_url = intershift_plugin._generate_login_url(
+                'site1', self.user.username
+            )
+
+        self.assertEquals(login_url, self.test_login_url)
+
+        time.sleep(0.15)
+
+        self.assertEquals(
+            get_local_cache().get_many(['intershift_sso_site1_john']), {}
+        )
+
+    @override_settings(
+        URL_SSO_METRICS_SINK='url_sso.tests.utils.RecordingSink'
+    )
+    def test_get_login_urls_metrics(self):
+        """ Test backend calls and cache lookups are instrumented """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with HTTMock(key_mock):
+            intershift_plugin.get_login_urls(self.request)
+
+        records = url_sso_settings.METRICS.records
+
+        self.assertTrue(('timing', 'cache', {
+            'plugin': 'intershift', 'tier': 'shared'
+        }) in records)
+        self.assertTrue(('increment', 'cache.misses', 2, {
+            'plugin': 'intershift', 'tier': 'shared'
+        }) in records)
+
+        for site_name in ('site2', 'site3'):
+            tags = {'plugin': 'intershift', 'site': site_name}
+
+            self.assertTrue(('timing', 'backend', tags) in records)
+            self.assertTrue(('increment', 'backend.calls', 1, tags) in records)
+
+    def test_sso_login_url_tag(self):
+        """ Test the sso_login_url tag only requests a key for its site """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        requests = []
+
+        def key_mock(url, request):
+            requests.append(url.path)
+
+            return self.test_xml
+
+        template = Template(
+            '{% load sso_tags %}'
+            '<a href="{% sso_login_url "intershift" "site3" %}">'
+            '<a href="{% sso_login_url "intershift" "site1" %}">'
+            '<a href="{% sso_login_url "iprova" "iportal" %}">'
+        )
+
+        with HTTMock(key_mock):
+            html = template.render(Context({'request': self.request}))
+
+        # Escaped URL for site3, no access to site1, iProva not enabled
+        self.assertEquals(
+            html,
+            '<a href="%s"><a href=""><a href="">' %
+            self.test_login_urls['INTERSHIFT_SITE3_SSO_URL'].replace(
+                '&', '&amp;'
+            )
+        )
+
+        self.assertEquals(requests, ['/site3/cust/singlesignon.asp'])
+
+    def test_get_login_urls_concurrent(self):
+        """ Test requesting keys concurrently """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        local_settings = intershift_settings.copy()
+        local_settings['max_workers'] = 4
+
+        def slow_mock(url, request):
+            time.sleep(0.2)
+
+            return self.test_xml
+
+        with override_settings(URL_SSO_INTERSHIFT=local_settings):
+            start = time.time()
+
+            with HTTMock(slow_mock):
+                urls = intershift_plugin.get_login_urls(self.request)
+
+            # Requests for site2 and site3 should run in parallel
+            self.assertTrue(time.time() - start < 0.35)
+
+        self.assertEquals(urls, self.test_login_urls)
+
+    def test_get_login_urls_batched_cache(self):
+        """ Test cache is read and written once for all sites """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        # Populate cache for site2 only
+        with HTTMock(key_mock):
+            intershift_plugin._generate_login_url('site2', self.user.username)
+
+        @urlmatch(path='/site2/cust/singlesignon.asp')
+        def fail_mock(url, request):
+            self.fail('Request should not be fired when using cache.')
+
+        with patch.object(
+            self.locmem_cache, 'get_many', wraps=self.locmem_cache.get_many
+        ) as get_many:
+            with patch.object(
+                self.locmem_cache, 'set_many', wraps=self.locmem_cache.set_many
+            ) as set_many:
+                with HTTMock(fail_mock, key_mock):
+                    urls = intershift_plugin.get_login_urls(self.request)
+
+        self.assertEquals(urls, self.test_login_urls)
+
+        get_many.assert_called_once_with([
+            'intershift_sso_site2_john', 'intershift_sso_site3_john'
+        ])
+        self.assertEquals(set_many.call_count, 1)
+
+        entries, timeout = set_many.call_args[0]
+        self.assertEquals(entries.keys(), ['intershift_sso_site3_john'])
+        self.assertEquals(
+            entries['intershift_sso_site3_john'][0],
+            self.test_login_urls['INTERSHIFT_SITE3_SSO_URL']
+        )
+        self.assertEquals(timeout, intershift_settings['key_expiration'])
+
+    def test_get_login_urls_batched_lease(self):
+        """ Test a single lease is taken for all sites requested together """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with patch.object(
+            self.locmem_cache, 'add', wraps=self.locmem_cache.add
+        ) as add:
+            with HTTMock(key_mock):
+                urls = intershift_plugin.get_login_urls(self.request)
+
+        self.assertEquals(urls, self.test_login_urls)
+        self.assertEquals(add.call_count, 1)
+
+    def test_generate_login_url_single_flight(self):
+        """ Test concurrent requests for the same key are coalesced """
+
+        requests = []
+
+        def slow_mock(url, request):
+            requests.append(url)
+            time.sleep(0.1)
+
+            return self.test_xml
+
+        login_urls = []
+
+        def generate():
+            login_urls.append(intershift_plugin._generate_login_url(
+                'site1', self.user.username
+            ))
+
+        threads = [threading.Thread(target=generate) for i in range(5)]
+
+        with HTTMock(slow_mock):
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEquals(len(requests), 1)
+        self.assertEquals(login_urls, [self.test_login_url] * 5)
+
+        # Lease should have been released
+        self.assertEquals(
+            self.locmem_cache.get('intershift_sso_site1_john_lease'), None
+        )
+
+    def test_generate_login_url_lease(self):
+        """ Test waiting for a key minted by another process """
+
+        # Pretend another process holds the lease
+        self.locmem_cache.add('intershift_sso_site1_john_lease', True, 10)
+
+        def publish():
+            time.sleep(0.1)
+            self.locmem_cache.set(
+                'intershift_sso_site1_john', self.test_login_url
+            )
+
+        def fail_mock(url, request):
+            self.fail('Request should not be fired when leased.')
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+
+        with HTTMock(fail_mock):
+            login_url = intershift_plugin._generate_login_url(
+                'site1', self.user.username
+            )
+
+        thread.join()
+
+        self.assertEquals(login_url, self.test_login_url)
+
+    @override_settings(URL_SSO_LEASE_WAIT=0.1)
+    def test_generate_login_url_lease_expired(self):
+        """ Test minting anyway when the lease holder takes too long """
+
+        # Pretend another process holds the lease
+        self.locmem_cache.add('intershift_sso_site1_john_lease', True, 10)
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with HTTMock(key_mock):
+            login_url = intershift_plugin._generate_login_url(
+                'site1', self.user.username
+            )
+
+        self.assertEquals(login_url, self.test_login_url)
+
+    def test_generate_login_url_lease_released(self):
+        """ Test waiting stops when the lease holder fails to mint """
+
+        # Pretend another process holds the lease
+        self.locmem_cache.add('intershift_sso_site1_john_lease', True, 10)
+
+        def release():
+            time.sleep(0.1)
+            self.locmem_cache.delete('intershift_sso_site1_john_lease')
+
+        def fail_mock(url, request):
+            self.fail('Request should not be fired when the holder failed.')
+
+        thread = threading.Thread(target=release)
+        thread.start()
+
+        start = time.time()
+
+        with HTTMock(fail_mock):
+            self.assertRaises(
+                RequestKeyException, intershift_plugin._generate_login_url,
+                'site1', self.user.username
+            )
+
+        thread.join()
+
+        self.assertTrue(time.time() - start < 1)
+
+    def test_generate_login_url_lease_deadline(self):
+        """ Test waiting for a lease is capped by the request deadline """
+
+        # Pretend another process holds the lease
+        self.locmem_cache.add('intershift_sso_site1_john_lease', True, 10)
+
+        def fail_mock(url, request):
+            self.fail('Request should not be fired past the deadline.')
+
+        start = time.time()
+
+        with HTTMock(fail_mock):
+            with use_deadline(time.time() + 0.2):
+                self.assertRaises(
+                    RequestKeyException,
+                    intershift_plugin._generate_login_url,
+                    'site1', self.user.username
+                )
+
+        self.assertTrue(time.time() - start < 1)
+
+    def test_generate_login_url_stale(self):
+        """ Test stale URL's are served while refreshing in the background """
+
+        local_settings = intershift_settings.copy()
+        local_settings['key_soft_expiration'] = 3600
+
+        stale_url = self.test_login_url.replace('BOGUSKEY', 'STALEKEY')
+
+        # Cached URL past its soft expiry
+        self.locmem_cache.set(
+            'intershift_sso_site1_john', (stale_url, time.time() - 1)
+        )
+
+        def key_mock(url, request):
+            return self.test_xml
+
+        with override_settings(URL_SSO_INTERSHIFT=local_settings):
+            with HTTMock(key_mock):
+                login_url = intershift_plugin._generate_login_url(
+                    'site1', self.user.username
+                )
+
+                # Stale URL should be served immediately
+                self.assertEquals(login_url, stale_url)
+
+                # Wait for background refresh
+                for i in range(20):
+                    login_url, soft_expiry = self.locmem_cache.get(
+                        'intershift_sso_site1_john'
+                    )[:2]
+
+                    if login_url != stale_url:
+                        break
+
+                    time.sleep(0.05)
+
+        self.assertEquals(login_url, self.test_login_url)
+        self.assertTrue(soft_expiry > time.time() + 3500)
+
+    def test_generate_login_url_stale_once(self):
+        """ Test stale URL's are refreshed once while the refresh is pending """
+
+        local_settings = intershift_settings.copy()
+        local_settings['key_soft_expiration'] = 3600
+
+        stale_url = self.test_login_url.replace('BOGUSKEY', 'STALEKEY')
+
+        # Cached URL past its soft expiry
+        self.locmem_cache.set(
+            'intershift_sso_site1_john', (stale_url, time.time() - 1)
+        )
+
+        def fail_mock(url, request):
+            self.fail('Request should not be fired for stale URL\'s.')
+
+        # Refreshes are queued but not started
+        with patch('url_sso.plugins.base.get_thread_pool') as get_thread_pool:
+            with override_settings(URL_SSO_INTERSHIFT=local_settings):
+                with HTTMock(fail_mock):
+                    for i in range(10):
+                        login_url = intershift_plugin._generate_login_url(
+                            'site1', self.user.username
+                        )
+
+        intershift_plugin._refreshing.clear()
+
+        self.assertEquals(login_url, stale_url)
+        pool = get_thread_pool.return_value
+        self.assertEquals(pool.apply_async.call_count, 1)
+
+    def test_refresh_many_fresh(self):
+        """ Test keys refreshed since being scheduled are not minted again """
+
+        self.locmem_cache.set(
+            'intershift_sso_site1_john',
+            (self.test_login_url, time.time() + 3600)
+        )
+
+        def mint(keys):
+            self.fail('Fresh keys should not be minted.')
+
+        intershift_plugin._refresh_many(
+            self.locmem_cache, ['intershift_sso_site1_john'], mint, 86400
+        )
+
+    @patch('url_sso.plugins.base.logger')
+    def test_refresh_many_error(self, mock_logger):
+        """ Test unexpected errors refreshing keys are logged """
+
+        def mint(keys):
+            raise AssertionError('User not authenticated.')
+
+        intershift_plugin._refresh_many(
+            self.locmem_cache, ['intershift_sso_site1_john'], mint, 86400
+        )
+
+        self.assertTrue(mock_logger.exception.called)
+        self.assertEquals(intershift_plugin._refreshing, set())
+
+    @override_settings(
+        URL_SSO_CIRCUIT_BREAKER_THRESHOLD=1,
+        URL_SSO_ERROR_TIMEOUTS={'url_sso.exceptions.RequestKeyException': 60}
+    )
+    def test_integration_budget_timeout(self):
+        """ Test timeouts cut short by the budget don't blame the backend """
+
+        server = SlowServer(delay=0.3, body=self.test_xml)
+        server.start()
+
+        local_settings = {
+            'secret': '12345678',
+            'sites': {
+                'a': {'url': server.url + 'a/'},
+            },
+            'key_expiration': 86400
+        }
+
+        try:
+            with override_settings(URL_SSO_INTERSHIFT=local_settings):
+                with use_deadline(time.time() + 0.1):
+                    self.assertRaises(
+                        RequestKeyException,
+                        intershift_plugin._generate_login_url,
+                        'a', self.user.username
+                    )
+
+                # Neither the breaker nor the negative cache are affected
+                self.assertEquals(
+                    self.locmem_cache.get('intershift_sso_a_john_error'), None
+                )
+
+                login_url = intershift_plugin._generate_login_url(
+                    'a', self.user.username
+                )
+
+        finally:
+            server.stop()
+
+        self.assertTrue(login_url.startswith(server.url + 'a/'))
+
+    def test_integration_budget(self):
+        """ Test sites share the latency budget of a request """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        server = SlowServer(delay=0.3, body=self.test_xml)
+        server.start()
+
+        local_settings = {
+            'secret': '12345678',
+            'sites': {
+                'site2': {'url': server.url + 'site2/'},
+                'site3': {'url': server.url + 'site3/'},
+            },
+            'key_expiration': 86400
+        }
+
+        try:
+            with override_settings(
+                URL_SSO_INTERSHIFT=local_settings, URL_SSO_BUDGET=0.45
+            ):
+                start = time.time()
+
+                context = dict(login_urls(self.request))
+
+                # Second site should be cut off by the budget
+                self.assertTrue(time.time() - start < 0.6)
+
+        finally:
+            server.stop()
+
+        self.assertEquals(context.keys(), ['INTERSHIFT_SITE2_SSO_URL'])
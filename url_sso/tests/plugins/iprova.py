@@ -18,15 +18,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import time
+import threading
+
+import suds
+
+from lxml import etree
 
 from mock import Mock, patch
-from httmock import HTTMock
+from httmock import urlmatch, HTTMock
 
 from django.core import cache
 
 from django.test import TestCase
 from django.test.utils import override_settings
 
+from url_sso.exceptions import (
+    RequestKeyException, InvalidResponseException, CircuitOpenException,
+    BudgetExhaustedException
+)
 from url_sso.plugins import iprova
 from url_sso.plugins.iprova import iprova_plugin
 from url_sso.tests.utils import RequestTestMixin, UserTestMixin
@@ -71,6 +81,9 @@ class iProvaTests(RequestTestMixin, UserTestMixin, TestCase):
         )
         self.cache_patch.start()
 
+        # Make sure SOAP clients are not reused between tests
+        iprova_plugin._reset_client()
+
         # Setup test WSDL for mock responses
         directory = os.path.join(os.path.dirname(__file__), '..', 'data')
 
@@ -145,6 +158,27 @@ class iProvaTests(RequestTestMixin, UserTestMixin, TestCase):
 
         self.assertEquals(answer, 'test_token_3')
 
+    def test_get_client_reuse(self):
+        """ Test SOAP clients are reused until the root URL changes """
+
+        with HTTMock(lambda url, request: self.test_wsdl):
+            client = iprova_plugin._get_client()
+
+        # Reusing the client should not even touch the WSDL cache
+        with patch.object(iprova.SudsDjangoCache, 'get') as cache_get:
+            self.assertTrue(iprova_plugin._get_client() is client)
+
+        self.assertFalse(cache_get.called)
+
+        local_settings = iprova_settings.copy()
+        local_settings['root_url'] = 'http://other.organisation.com/'
+
+        with override_settings(URL_SSO_IPROVA=local_settings):
+            with HTTMock(lambda url, request: self.test_wsdl):
+                other_client = iprova_plugin._get_client()
+
+        self.assertFalse(other_client is client)
+
     @patch('url_sso.plugins.iprova.iprova_plugin._get_webservice')
     def test_request_token(self, mock_method):
         """ Test _request_token() """
@@ -166,6 +200,210 @@ class iProvaTests(RequestTestMixin, UserTestMixin, TestCase):
 
         self.assertEquals(token, self.test_token)
 
+    def test_fast_soap_envelope(self):
+        """ Test the prebuilt SOAP request against the WSDL """
+
+        wsdl = etree.fromstring(self.test_wsdl)
+        namespaces = {
+            'wsdl': 'http://schemas.xmlsoap.org/wsdl/',
+            's': 'http://www.w3.org/2001/XMLSchema',
+            'soap': 'http://schemas.xmlsoap.org/wsdl/soap/'
+        }
+
+        self.assertEquals(
+            wsdl.get('targetNamespace'), iprova.IPROVA_NAMESPACE
+        )
+
+        # Request parameters, in order
+        parameters = wsdl.xpath(
+            '//s:element[@name="GetTokenForUser"]//s:element/@name',
+            namespaces=namespaces
+        )
+        self.assertEquals(
+            parameters, ['strTrustedApplicationID', 'strLoginCode']
+        )
+
+        soap_actions = wsdl.xpath(
+            '//wsdl:binding/wsdl:operation[@name="GetTokenForUser"]'
+            '/soap:operation/@soapAction',
+            namespaces=namespaces
+        )
+        self.assertEquals(
+            soap_actions, [iprova.IPROVA_NAMESPACE + 'GetTokenForUser']
+        )
+
+        # The envelope should be well-formed and match the WSDL
+        envelope = etree.fromstring(iprova.GET_TOKEN_ENVELOPE.format(
+            namespace=iprova.IPROVA_NAMESPACE,
+            application_id='app',
+            username='john'
+        ))
+        request = envelope.find(
+            './/{%s}GetTokenForUser' % iprova.IPROVA_NAMESPACE
+        )
+        self.assertEquals(
+            [etree.QName(child).localname for child in request], parameters
+        )
+
+    def test_request_token_fast(self):
+        """ Test _request_token() using the fast SOAP path """
+
+        local_settings = iprova_settings.copy()
+        local_settings['fast_soap'] = True
+
+        @urlmatch(
+            netloc='intranet.organisation.com',
+            path='/Management/Webservices/UserManagementAPI.asmx',
+            method='POST'
+        )
+        def soap_mock(url, request):
+            envelope = etree.fromstring(request.body)
+
+            login_code = envelope.find(
+                './/{%s}strLoginCode' % iprova.IPROVA_NAMESPACE
+            )
+            self.assertEquals(login_code.text, 'test&user')
+
+            return self.test_response.format(token=self.test_token)
+
+        def fail_mock(url, request):
+            self.fail('Suds should not be used.')
+
+        with override_settings(URL_SSO_IPROVA=local_settings):
+            with HTTMock(soap_mock, fail_mock):
+                token = iprova_plugin._request_token('test&user')
+
+        self.assertEquals(token, self.test_token)
+
+    def test_request_token_fast_fallback(self):
+        """ Test falling back to suds on unexpected responses """
+
+        local_settings = iprova_settings.copy()
+        local_settings['fast_soap'] = True
+
+        @urlmatch(netloc='intranet.organisation.com', method='POST')
+        def broken_mock(url, request):
+            return '<html>Service unavailable</html>'
+
+        @urlmatch(method='GET')
+        def wsdl_mock(url, request):
+            return self.test_wsdl
+
+        # Suds posts to the address in the WSDL
+        @urlmatch(netloc='hpa.iprova.nl', method='POST')
+        def suds_mock(url, request):
+            return self.test_response.format(token=self.test_token)
+
+        with override_settings(URL_SSO_IPROVA=local_settings):
+            with HTTMock(broken_mock, wsdl_mock, suds_mock):
+                token = iprova_plugin._request_token('test_user')
+
+        self.assertEquals(token, self.test_token)
+
+    @override_settings(URL_SSO_CIRCUIT_BREAKER_THRESHOLD=1)
+    def test_request_token_fast_fault(self):
+        """ Test SOAP faults are raised without falling back to suds """
+
+        local_settings = iprova_settings.copy()
+        local_settings['fast_soap'] = True
+
+        requests = []
+
+        @urlmatch(netloc='intranet.organisation.com', method='POST')
+        def fault_mock(url, request):
+            requests.append(url)
+
+            return {
+                'status_code': 500,
+                'content': (
+                    '<soap:Envelope xmlns:soap='
+                    '"http://schemas.xmlsoap.org/soap/envelope/">'
+                    '<soap:Body><soap:Fault>'
+                    '<faultcode>soap:Server</faultcode>'
+                    '<faultstring>Unknown user</faultstring>'
+                    '</soap:Fault></soap:Body></soap:Envelope>'
+                )
+            }
+
+        def fail_mock(url, request):
+            self.fail('Suds should not be used.')
+
+        with override_settings(URL_SSO_IPROVA=local_settings):
+            with HTTMock(fault_mock, fail_mock):
+                # The breaker stays closed
+                for i in range(2):
+                    self.assertRaises(
+                        InvalidResponseException,
+                        lambda: iprova_plugin._request_token('test_user')
+                    )
+
+        self.assertEquals(len(requests), 2)
+
+    @override_settings(URL_SSO_CIRCUIT_BREAKER_THRESHOLD=1)
+    @patch('url_sso.plugins.iprova.iprova_plugin._get_webservice')
+    def test_request_token_circuit_breaker(self, mock_method):
+        """ Test SOAP requests are refused when the backend fails """
+
+        mock_method.side_effect = Exception('Connection refused')
+
+        self.assertRaises(
+            RequestKeyException,
+            lambda: iprova_plugin._request_token('test_user')
+        )
+
+        self.assertRaises(
+            CircuitOpenException,
+            lambda: iprova_plugin._request_token('test_user')
+        )
+
+        mock_method.assert_called_once_with()
+
+    @override_settings(URL_SSO_CIRCUIT_BREAKER_THRESHOLD=1)
+    @patch('url_sso.plugins.iprova.iprova_plugin._get_webservice')
+    def test_request_token_fault_circuit_breaker(self, mock_method):
+        """ Test SOAP faults don't open the circuit breaker """
+
+        fault = Mock(faultstring='Unknown user')
+
+        get_token = mock_method.return_value.GetTokenForUser
+        get_token.side_effect = suds.WebFault(fault, None)
+
+        for i in range(2):
+            self.assertRaises(
+                InvalidResponseException,
+                lambda: iprova_plugin._request_token('test_user')
+            )
+
+        self.assertEquals(get_token.call_count, 2)
+
+    @override_settings(
+        URL_SSO_CIRCUIT_BREAKER_THRESHOLD=1,
+        URL_SSO_ERROR_TIMEOUTS={'url_sso.exceptions.RequestKeyException': 300}
+    )
+    @patch('url_sso.plugins.iprova.iprova_plugin._get_webservice')
+    def test_request_token_budget_exhausted(self, mock_method):
+        """ Test an exhausted budget neither opens the breaker nor is cached """
+
+        mock_method.side_effect = BudgetExhaustedException('Exhausted')
+
+        self.assertRaises(
+            BudgetExhaustedException,
+            lambda: iprova_plugin._get_login_token('john')
+        )
+
+        self.assertEquals(
+            self.locmem_cache.get('iprova_sso_john_error'), None
+        )
+
+        # The breaker is still closed
+        mock_method.side_effect = None
+        mock_method.return_value.GetTokenForUser.return_value = \
+            self.test_token
+
+        self.assertEquals(
+            iprova_plugin._get_login_token('john'), self.test_token
+        )
+
     def test_get_cache_key(self):
         """ Test _get_cache_key() """
 
@@ -188,6 +426,54 @@ class iProvaTests(RequestTestMixin, UserTestMixin, TestCase):
         # Due to cache, _request_token should have only been called once
         mock_method.assert_called_once_with('test_user')
 
+    @patch('url_sso.plugins.iprova.iprova_plugin._request_token')
+    def test_get_login_token_single_flight(self, mock_method):
+        """ Test concurrent token requests for a user are coalesced """
+
+        def slow_request(username):
+            time.sleep(0.1)
+
+            return self.test_token
+
+        mock_method.side_effect = slow_request
+
+        tokens = []
+
+        def get_token():
+            tokens.append(iprova_plugin._get_login_token('test_user'))
+
+        threads = [threading.Thread(target=get_token) for i in range(5)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        mock_method.assert_called_once_with('test_user')
+        self.assertEquals(tokens, [self.test_token] * 5)
+
+    @patch('url_sso.plugins.iprova.iprova_plugin._request_token')
+    def test_get_login_token_soft_expiration(self, mock_method):
+        """ Test tokens are stored with a soft expiry """
+
+        local_settings = iprova_settings.copy()
+        local_settings['key_soft_expiration'] = 1800
+
+        mock_method.return_value = self.test_token
+
+        with override_settings(URL_SSO_IPROVA=local_settings):
+            token = iprova_plugin._get_login_token('test_user')
+
+        self.assertEquals(token, self.test_token)
+
+        token, soft_expiry, expiry = self.locmem_cache.get(
+            'iprova_sso_test_user'
+        )
+        self.assertEquals(token, self.test_token)
+        self.assertTrue(time.time() < soft_expiry < time.time() + 1800)
+        self.assertTrue(time.time() + 1800 < expiry < time.time() + 3600)
+
     def test_generate_login_url(self):
         """ Test _generate_login_url() """
 
@@ -225,6 +511,36 @@ class iProvaTests(RequestTestMixin, UserTestMixin, TestCase):
 
         mock_method.assert_called_once_with(self.user.username)
 
+    @patch('url_sso.plugins.iprova.iprova_plugin._get_login_token')
+    def test_get_login_url(self, mock_method):
+        """ Test get_login_url() for a single service """
+
+        # Make sure user is set on the request
+        self.request.user = self.user
+
+        mock_method.return_value = self.test_token
+
+        local_settings = iprova_settings.copy()
+        local_settings['has_access'] = \
+            lambda request, service: service == 'iportal'
+
+        with override_settings(URL_SSO_IPROVA=local_settings):
+            self.assertEquals(
+                iprova_plugin.get_login_url(self.request, 'iportal'),
+                'http://intranet.organisation.com/iportal/?token=' +
+                self.test_token
+            )
+
+            # No access or unknown service
+            self.assertEquals(
+                iprova_plugin.get_login_url(self.request, 'itask'), None
+            )
+            self.assertEquals(
+                iprova_plugin.get_login_url(self.request, 'bogus'), None
+            )
+
+        mock_method.assert_called_once_with(self.user.username)
+
     @patch('url_sso.plugins.iprova.iprova_plugin._get_login_token')
     def test_has_access(self, mock_method):
         """ Test get_login_urls() with has_access = False """
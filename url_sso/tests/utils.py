@@ -19,9 +19,17 @@
 
 """ Test utils """
 
+import time
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
 from django.test.client import RequestFactory
 from django.contrib.auth.models import User
 
+from url_sso.metrics import MetricsSink
+
 
 class UserTestMixin(object):
     """ TestCase mixin for tests requiring a logged in user. """
@@ -55,3 +63,78 @@ class RequestTestMixin(object):
 
         # Call super
         super(RequestTestMixin, self).setUp()
+
+
+class SlowRequestHandler(BaseHTTPRequestHandler):
+    """ Respond with the server's body after the server's delay. """
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+
+        self.wfile.write(self.server.body)
+
+    def log_message(self, format, *args):
+        # Keep test output clean
+        pass
+
+
+class SlowServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server responding to GET requests after `delay` seconds,
+    used as a deliberately slow backend.
+
+    Example::
+
+        server = SlowServer(delay=0.5, body='<xml />')
+        server.start()
+        requests.get(server.url)
+        server.stop()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay, body=''):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SlowRequestHandler)
+
+        self.delay = delay
+        self.body = body
+
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        """ Serve requests from a background thread. """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients giving up (broken pipes) are expected
+        pass
+
+
+class RecordingSink(MetricsSink):
+    """ Metrics sink keeping metrics in `records`, for tests. """
+
+    def __init__(self):
+        self.records = []
+
+    def timing(self, name, value, tags):
+        self.records.append(('timing', name, tags))
+
+    def increment(self, name, value, tags):
+        self.records.append(('increment', name, value, tags))
+
+    def get_names(self):
+        """ Return names of recorded metrics. """
+
+        return [record[1] for record in self.records]
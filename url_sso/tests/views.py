@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Tests for views. """
+
+import json
+
+from mock import patch
+from httmock import HTTMock
+
+from django.core import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from url_sso.context_processors import login_urls
+from url_sso.plugins import intershift
+
+from .plugins.intershift import (
+    sso_settings, intershift_settings, IntershiftTests
+)
+from .utils import RequestTestMixin, UserTestMixin
+
+
+@override_settings(**sso_settings)
+class LoginRedirectTests(RequestTestMixin, UserTestMixin, TestCase):
+    """ Tests for views and context modes """
+
+    urls = 'url_sso.urls'
+
+    def setUp(self):
+        # Setup local memory cache for tests
+        self.locmem_cache = cache.get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        self.locmem_cache.clear()
+
+        self.cache_patch = patch.object(
+            intershift, 'cache', self.locmem_cache
+        )
+        self.cache_patch.start()
+
+        super(LoginRedirectTests, self).setUp()
+
+        self.requests = []
+
+    def tearDown(self):
+        self.cache_patch.stop()
+
+    def key_mock(self, url, request):
+        self.requests.append(url.path)
+
+        return IntershiftTests.test_xml
+
+    def test_redirect(self):
+        """ Test redirecting to the login URL of a single site """
+
+        with HTTMock(self.key_mock):
+            response = self.client.get('/intershift/site3/')
+
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(
+            response['Location'],
+            IntershiftTests.test_login_urls['INTERSHIFT_SITE3_SSO_URL']
+        )
+        self.assertTrue('max-age=0' in response['Cache-Control'])
+
+        self.assertEquals(self.requests, ['/site3/cust/singlesignon.asp'])
+
+        # The key is reused
+        with HTTMock(self.key_mock):
+            response = self.client.get('/intershift/site3/')
+
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(len(self.requests), 1)
+
+    def test_redirect_not_found(self):
+        """ Test 404 for unknown plugins, sites or sites without access """
+
+        with HTTMock(self.key_mock):
+            for path in (
+                '/intershift/site1/', '/intershift/bogus/', '/bogus/site3/'
+            ):
+                response = self.client.get(path)
+
+                self.assertEquals(response.status_code, 404)
+
+        self.assertEquals(self.requests, [])
+
+    def test_redirect_error(self):
+        """ Test 502 when no key could be obtained """
+
+        def error_mock(url, request):
+            return {'status_code': 500}
+
+        with HTTMock(error_mock):
+            response = self.client.get('/intershift/site3/')
+
+        self.assertEquals(response.status_code, 502)
+
+    def test_redirect_anonymous(self):
+        """ Test anonymous users are sent to the login page """
+
+        self.client.logout()
+
+        with HTTMock(self.key_mock):
+            response = self.client.get('/intershift/site3/')
+
+        self.assertEquals(response.status_code, 302)
+        self.assertTrue('/site3/' in response['Location'])
+        self.assertEquals(self.requests, [])
+
+    @override_settings(URL_SSO_CONTEXT_MODE='redirect')
+    def test_context_mode(self):
+        """ Test the context holds local redirect URL's """
+
+        self.request.user = self.user
+
+        with HTTMock(self.key_mock):
+            urls = dict(login_urls(self.request))
+
+        self.assertEquals(urls, {
+            'INTERSHIFT_SITE2_SSO_URL': '/intershift/site2/',
+            'INTERSHIFT_SITE3_SSO_URL': '/intershift/site3/'
+        })
+
+        self.assertEquals(self.requests, [])
+
+    def test_context_mode_names(self):
+        """ Test redirect URL's for names which are not plain words """
+
+        local_settings = intershift_settings.copy()
+        local_settings['sites'] = {
+            'portal.nl': {
+                'url': 'https://customer1.intershift.nl/portal/singlesignon.asp'
+            }
+        }
+
+        self.request.user = self.user
+
+        with self.settings(
+            URL_SSO_CONTEXT_MODE='redirect',
+            URL_SSO_INTERSHIFT=local_settings
+        ):
+            urls = dict(login_urls(self.request))
+
+            with HTTMock(self.key_mock):
+                response = self.client.get('/intershift/portal.nl/')
+
+        self.assertEquals(urls, {
+            'INTERSHIFT_PORTAL.NL_SSO_URL': '/intershift/portal.nl/'
+        })
+
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(self.requests, ['/portal/singlesignon.asp'])
+
+    def test_context_mode_no_reverse(self):
+        """ Test falling back to login URL's when redirects can't be reversed """
+
+        local_settings = intershift_settings.copy()
+        local_settings['sites'] = {
+            'intra/net': {
+                'url': 'https://customer1.intershift.nl/intranet/singlesignon.asp'
+            }
+        }
+
+        self.request.user = self.user
+
+        with self.settings(
+            URL_SSO_CONTEXT_MODE='redirect',
+            URL_SSO_INTERSHIFT=local_settings
+        ):
+            with HTTMock(self.key_mock):
+                urls = dict(login_urls(self.request))
+
+        self.assertTrue(urls['INTERSHIFT_INTRA/NET_SSO_URL'].startswith(
+            'https://customer1.intershift.nl/intranet/singlesignon.asp?'
+        ))
+
+    def test_login_urls_json(self):
+        """ Test login URL's as JSON, with cache headers and ETag """
+
+        with HTTMock(self.key_mock):
+            response = self.client.get('/login_urls.json')
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/json')
+        self.assertEquals(
+            json.loads(response.content), IntershiftTests.test_login_urls
+        )
+
+        self.assertTrue('private' in response['Cache-Control'])
+        self.assertTrue('max-age=60' in response['Cache-Control'])
+
+        etag = response['ETag']
+
+        # Unchanged URL's are not sent again, nor requested from backends
+        with HTTMock(self.key_mock):
+            response = self.client.get(
+                '/login_urls.json', HTTP_IF_NONE_MATCH=etag
+            )
+
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response['ETag'], etag)
+
+        self.assertEquals(len(self.requests), 2)
+
+    @override_settings(URL_SSO_CONTEXT_MODE='deferred')
+    def test_context_mode_deferred(self):
+        """ Test the context only holds the JSON endpoint """
+
+        self.request.user = self.user
+
+        with HTTMock(self.key_mock):
+            context = login_urls(self.request)
+
+        self.assertEquals(context, {
+            'SSO_LOGIN_URLS_ENDPOINT': '/login_urls.json'
+        })
+
+        self.assertEquals(self.requests, [])
+
+    @override_settings(
+        URL_SSO_CONTEXT_MODE='deferred',
+        ROOT_URLCONF='django.contrib.auth.urls'
+    )
+    def test_context_mode_deferred_no_reverse(self):
+        """ Test falling back to login URL's without the JSON endpoint """
+
+        self.request.user = self.user
+
+        with HTTMock(self.key_mock):
+            urls = dict(login_urls(self.request))
+
+        self.assertEquals(urls, IntershiftTests.test_login_urls)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# This file is part of django-url-sso.
+#
+# django-url-sso: Generate login URL's for unstandardized SSO systems.
+# Copyright (C) 2014 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" URL's for django-url-sso, i.e. `url(r'^sso/', include('url_sso.urls'))`. """
+
+from django.conf.urls import patterns, url
+
+
+urlpatterns = patterns('url_sso.views',
+    url(r'^login_urls.json$', 'login_urls_json', name='url_sso_login_urls'),
+    url(
+        r'^(?P<plugin_name>\w+)/(?P<name>[^/]+)/$', 'login_redirect',
+        name='url_sso_login_redirect'
+    ),
+)
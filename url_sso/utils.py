@@ -17,12 +17,32 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
+import time
+import hashlib
+import threading
+
+from contextlib import contextmanager
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 from django.conf import settings as django_settings
+from django.db import connections
 from django.utils.importlib import import_module
 from django.core.cache import cache
 
 from suds.cache import Cache
 
+from .exceptions import BudgetExhaustedException
+
 
 class Singleton(type):
     """
@@ -66,15 +86,33 @@ class SettingsBase(object):
         """
         assert hasattr(self, 'settings_prefix'), 'No prefix specified.'
 
+        # Resolved settings, cleared by reset()
+        self._values = {}
+
+    def reset(self):
+        """
+        Forget resolved settings, i.e. when Django's `setting_changed`
+        signal is sent.
+        """
+
+        self._values = {}
+
     def __getattr__(self, attr):
         """
         Return Django setting `PREFIX_SETTING` if explicitly specified,
         otherwise return `PREFIX_SETTING_DEFAULT` if specified.
+
+        Resolved settings are memoized until reset() is called.
         """
 
         if attr.isupper():
             # Require settings to have uppercase characters
 
+            try:
+                return self._values[attr]
+            except KeyError:
+                pass
+
             try:
                 setting = getattr(
                     django_settings,
@@ -86,6 +124,8 @@ class SettingsBase(object):
                 else:
                     raise
 
+            self._values[attr] = setting
+
             return setting
 
         else:
@@ -119,9 +159,694 @@ class SudsDjangoCache(Cache):
         cache.delete(self._cache_key(id))
 
 
+class CircuitBreaker(object):
+    """
+    Circuit breaker for a single backend.
+
+    The breaker is closed while calls succeed. After `failure_threshold`
+    consecutive failures it opens, refusing calls for `reset_timeout`
+    seconds. After that it is half-open, allowing a single trial call:
+    success closes the breaker, failure opens it again.
+
+    When a Django `cache` is given, state is shared through the cache
+    (i.e. between worker processes), otherwise it is kept in memory.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout, cache=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.cache = cache
+
+        self._lock = threading.Lock()
+
+        # Local state: consecutive failures and time until which it is open
+        self._failures = 0
+        self._opened_until = None
+        self._trial = False
+
+    def _get_cache_key(self, suffix=''):
+        return 'url_sso_breaker_{0}{1}'.format(self.name, suffix)
+
+    def _load(self):
+        """ Return (failures, opened_until). """
+
+        if self.cache is not None:
+            return self.cache.get(self._get_cache_key(), (0, None))
+
+        return (self._failures, self._opened_until)
+
+    def _save(self, failures, opened_until):
+        if self.cache is not None:
+            # Keep state around for a while after the breaker closes
+            self.cache.set(
+                self._get_cache_key(), (failures, opened_until),
+                self.reset_timeout * 10
+            )
+        else:
+            self._failures = failures
+            self._opened_until = opened_until
+
+    def _acquire_trial(self):
+        """ Return whether this caller may perform the half-open trial. """
+
+        if self.cache is not None:
+            return self.cache.add(
+                self._get_cache_key('_trial'), True, self.reset_timeout
+            )
+
+        if self._trial:
+            return False
+
+        self._trial = True
+
+        return True
+
+    def _release_trial(self):
+        if self.cache is not None:
+            self.cache.delete(self._get_cache_key('_trial'))
+        else:
+            self._trial = False
+
+    @property
+    def state(self):
+        """ Return current state of the breaker. """
+
+        failures, opened_until = self._load()
+
+        if opened_until is None:
+            return self.CLOSED
+
+        if time.time() < opened_until:
+            return self.OPEN
+
+        return self.HALF_OPEN
+
+    def allow(self):
+        """ Return whether a call to the backend may be made. """
+
+        with self._lock:
+            state = self.state
+
+            if state == self.CLOSED:
+                return True
+
+            if state == self.OPEN:
+                return False
+
+            return self._acquire_trial()
+
+    def record_success(self):
+        """ Record a successful call, closing the breaker. """
+
+        with self._lock:
+            if self._load() != (0, None):
+                self._save(0, None)
+
+            self._release_trial()
+
+    def release(self):
+        """
+        Release the half-open trial, if taken, without recording a result,
+        i.e. when a call was abandoned for reasons unrelated to the backend.
+        """
+
+        with self._lock:
+            self._release_trial()
+
+    def record_failure(self):
+        """ Record a failed call, opening the breaker when required. """
+
+        with self._lock:
+            failures, opened_until = self._load()
+            failures += 1
+
+            if opened_until is not None or \
+                    failures >= self.failure_threshold:
+                opened_until = time.time() + self.reset_timeout
+
+            self._save(failures, opened_until)
+            self._release_trial()
+
+
+class RateLimiter(object):
+    """
+    Thread-safe limiter allowing at most `rate` calls to wait() per second,
+    by spacing calls evenly.
+    """
+
+    def __init__(self, rate):
+        assert rate > 0
+
+        self.interval = 1.0 / rate
+
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        """ Block until the next call is allowed. """
+
+        with self._lock:
+            now = time.time()
+
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BackendRateLimiter(object):
+    """
+    Thread-safe limiter allowing at most `rate` calls to wait() per second
+    for each backend.
+    """
+
+    def __init__(self, rate):
+        assert rate > 0
+
+        self.rate = rate
+
+        self._lock = threading.Lock()
+        self._rate_limiters = {}
+
+    def wait(self, backend):
+        """ Block until the next call to `backend` is allowed. """
+
+        with self._lock:
+            rate_limiter = self._rate_limiters.get(backend)
+
+            if rate_limiter is None:
+                rate_limiter = RateLimiter(self.rate)
+                self._rate_limiters[backend] = rate_limiter
+
+        rate_limiter.wait()
+
+
+class HitCounter(object):
+    """ Thread safe counter for cache hits and misses. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.reset()
+
+    def record(self, hits, misses):
+        """ Add `hits` and `misses` to the counts. """
+
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def reset(self):
+        """ Reset counts to zero. """
+
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def as_dict(self):
+        """ Return counts as a dict. """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class LocalCache(object):
+    """
+    Bounded in-process cache. Entries expire after their timeout and the
+    least recently used entry is evicted once `max_entries` is exceeded.
+    Hits and misses are counted in `stats`.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.stats = HitCounter()
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_many(self, keys):
+        """ Return a dict with the values found for `keys`. """
+
+        now = time.time()
+
+        values = {}
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+
+                if entry is None or entry[1] <= now:
+                    continue
+
+                # Reinsert as most recently used
+                self._entries[key] = entry
+
+                values[key] = entry[0]
+
+        self.stats.record(len(values), len(keys) - len(values))
+
+        return values
+
+    def set(self, key, value, timeout):
+        """ Store `value` for `timeout` seconds. """
+
+        if timeout <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + timeout)
+
+            # Evict least recently used entries
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def delete_many(self, keys):
+        """ Remove `keys` from the cache. """
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Remove all entries. """
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Flight(object):
+    """ Minting of a single cached value in progress. """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent minting of cached values (cache stampede protection).
+
+    Within a process, only one thread mints the value for a cache key while
+    other threads wait for its result. Across processes, a short lease
+    acquired through `cache.add()` allows a single worker to mint the value
+    while others poll the cache for it. A single lease is taken for all
+    keys minted together, keyed on the set of keys.
+    """
+
+    # Seconds between polling the cache while another process holds a lease
+    poll_interval = 0.05
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def in_flight(self, key):
+        """ Return whether a value for `key` is being minted. """
+
+        return key in self._flights
+
+    def _get_lease_key(self, keys):
+        """ Return cache key for the lease on a set of keys. """
+
+        if len(keys) == 1:
+            return '{0}_lease'.format(keys[0])
+
+        digest = hashlib.md5('\n'.join(sorted(keys))).hexdigest()
+
+        return 'url_sso_lease_{0}'.format(digest)
+
+    def mint_many(self, cache, keys, mint, timeout,
+                  lease_timeout=None, lease_wait=0):
+        """
+        Return a dict with values for `keys`, which are missing from `cache`.
+
+        `mint(keys)` is called to request missing values from the backend
+        and should return a dict with the values it obtained, which are
+        stored in the cache for `timeout` seconds. Keys for which minting
+        failed are left out of the result.
+
+        When `lease_timeout` is set, a lease is acquired for `lease_timeout`
+        seconds before minting. Keys leased by other processes are polled
+        for up to `lease_wait` seconds before minting them anyway.
+
+        Waiting for other threads or processes is limited by the deadline of
+        the current request. BudgetExhaustedException is raised when it
+        passes while another thread is minting.
+        """
+
+        leading = []
+        following = []
+
+        with self._lock:
+            for key in keys:
+                flight = self._flights.get(key)
+
+                if flight is None:
+                    flight = _Flight()
+                    self._flights[key] = flight
+
+                    leading.append((key, flight))
+                else:
+                    following.append((key, flight))
+
+        values = {}
+
+        if leading:
+            try:
+                values.update(self._mint_leased(
+                    cache, [key for key, flight in leading], mint, timeout,
+                    lease_timeout, lease_wait
+                ))
+
+            except Exception, e:
+                for key, flight in leading:
+                    flight.exception = e
+
+                raise
+
+            finally:
+                with self._lock:
+                    for key, flight in leading:
+                        del self._flights[key]
+
+                        flight.value = values.get(key)
+                        flight.event.set()
+
+        for key, flight in following:
+            # Don't wait past the deadline of the current request, as the
+            # leading thread may not have one
+            remaining = get_remaining_time()
+
+            if remaining is None:
+                flight.event.wait()
+            else:
+                flight.event.wait(max(remaining, 0))
+
+                if not flight.event.is_set():
+                    raise BudgetExhaustedException(
+                        'Latency budget exhausted waiting for %s.' % key
+                    )
+
+            if flight.exception is not None:
+                raise flight.exception
+
+            if flight.value is not None:
+                values[key] = flight.value
+
+        return values
+
+    def _mint(self, cache, keys, mint, timeout):
+        """ Mint values for keys and store them in the cache. """
+
+        values = mint(keys)
+
+        if values:
+            cache.set_many(values, timeout)
+
+        return values
+
+    def _mint_leased(self, cache, keys, mint, timeout,
+                     lease_timeout, lease_wait):
+        """ Mint values for keys, coordinating with other processes. """
+
+        if not lease_timeout:
+            return self._mint(cache, keys, mint, timeout)
+
+        lease_key = self._get_lease_key(keys)
+
+        if cache.add(lease_key, True, lease_timeout):
+            try:
+                return self._mint(cache, keys, mint, timeout)
+            finally:
+                cache.delete(lease_key)
+
+        values, leased = self._wait(cache, keys, lease_key, lease_wait)
+
+        # Mint values not published by the lease holder in time; when the
+        # lease was released without them, the holder failed to mint them
+        missing = [key for key in keys if key not in values]
+
+        if leased and missing:
+            values.update(self._mint(cache, missing, mint, timeout))
+
+        return values
+
+    def _wait(self, cache, keys, lease_key, lease_wait):
+        """
+        Poll cache for keys for up to `lease_wait` seconds, limited by the
+        latency budget of the current request. Stops waiting once all values
+        are published or the lease is released.
+
+        Returns a dict with values found and whether the lease is still
+        held.
+        """
+
+        remaining = get_remaining_time()
+        if remaining is not None:
+            lease_wait = min(lease_wait, max(remaining, 0))
+
+        deadline = time.time() + lease_wait
+
+        values = {}
+
+        while True:
+            missing = [key for key in keys if key not in values]
+            entries = cache.get_many(missing + [lease_key])
+
+            for key in missing:
+                if key in entries:
+                    values[key] = entries[key]
+
+            leased = lease_key in entries
+
+            now = time.time()
+            if len(values) == len(keys) or not leased or now >= deadline:
+                return values, leased
+
+            time.sleep(min(self.poll_interval, deadline - now))
+
+
 def import_object(from_path):
     """ Given an import path, return the object it represents. """
 
     module, attr = from_path.rsplit(".", 1)
     mod = import_module(module)
     return getattr(mod, attr)
+
+
+# Thread pools by name, size and process id
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def get_thread_pool(name, size):
+    """
+    Return a long-lived thread pool of `size` threads for `name`.
+
+    Pools are created lazily and are specific to the current process, such
+    that pools created before forking (e.g. preloading application servers)
+    are not reused in the child processes.
+    """
+
+    key = (name, size, os.getpid())
+
+    with _thread_pools_lock:
+        pool = _thread_pools.get(key)
+
+        if pool is None:
+            pool = ThreadPool(size)
+            _thread_pools[key] = pool
+
+    return pool
+
+
+def call_in_thread(func, *args, **kwargs):
+    """
+    Call `func` from a pool thread, closing database connections opened
+    by it (e.g. from `has_access` callables) afterwards.
+    """
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+# Thread-local state, i.e. the deadline for the current request and the
+# rate limiter for backend calls
+_local = threading.local()
+
+
+def get_deadline():
+    """
+    Return the deadline (as a timestamp) for backend calls in the current
+    thread, or None.
+    """
+
+    return getattr(_local, 'deadline', None)
+
+
+def get_remaining_time():
+    """ Return seconds left until the current deadline, or None. """
+
+    deadline = get_deadline()
+
+    if deadline is None:
+        return None
+
+    return deadline - time.time()
+
+
+@contextmanager
+def use_deadline(deadline):
+    """
+    Context manager setting the deadline for backend calls in the current
+    thread. An earlier deadline already in effect is kept.
+    """
+
+    previous = get_deadline()
+
+    if deadline is not None and (previous is None or deadline < previous):
+        _local.deadline = deadline
+
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def get_rate_limiter():
+    """
+    Return the BackendRateLimiter for backend calls in the current thread,
+    or None.
+    """
+
+    return getattr(_local, 'rate_limiter', None)
+
+
+@contextmanager
+def use_rate_limiter(rate_limiter):
+    """
+    Context manager limiting backend calls in the current thread with
+    `rate_limiter`, a BackendRateLimiter.
+    """
+
+    previous = get_rate_limiter()
+
+    _local.rate_limiter = rate_limiter
+
+    try:
+        yield
+    finally:
+        _local.rate_limiter = previous
+
+
+def call_with_deadline(deadline, func, *args, **kwargs):
+    """
+    Call `func` from a pool thread like `call_in_thread()`, using the
+    deadline of the thread submitting the call.
+    """
+
+    with use_deadline(deadline):
+        return call_in_thread(func, *args, **kwargs)
+
+
+class PoolCall(object):
+    """
+    Call submitted to a thread pool, which the submitting thread runs itself
+    when no pool thread has started it by the time its result is needed.
+
+    Pools are shared by all requests in a process. Calls queued behind
+    other requests' calls thus never take longer than calling them one by
+    one from the submitting thread.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+        # Deadline of the submitting thread, for use in pool threads
+        self.deadline = get_deadline()
+
+        self._lock = threading.Lock()
+        self._claimed = False
+
+        self._event = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+        # Time the call finished
+        self.finished = None
+
+    def claim(self):
+        """
+        Return whether the call was claimed to be run (or skipped) by the
+        current thread, i.e. no other thread started it.
+        """
+
+        with self._lock:
+            if self._claimed:
+                return False
+
+            self._claimed = True
+
+            return True
+
+    def _run(self):
+        try:
+            self._value = self.func(*self.args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self.finished = time.time()
+            self._event.set()
+
+    def run_in_thread(self):
+        """ Run the call from a pool thread, unless already claimed. """
+
+        if self.claim():
+            call_with_deadline(self.deadline, self._run)
+
+    def run_here(self):
+        """ Run the call in the current thread, unless already claimed. """
+
+        if self.claim():
+            self._run()
+
+    def get(self, timeout=None):
+        """
+        Return the result of the call, waiting up to `timeout` seconds.
+        Raises TimeoutError when it is not done by then.
+        """
+
+        self._event.wait(timeout)
+
+        if not self._event.is_set():
+            raise TimeoutError
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._value
+
+
+def submit_call(pool, func, *args):
+    """ Submit `func(*args)` to `pool`, returning a PoolCall. """
+
+    call = PoolCall(func, *args)
+
+    pool.apply_async(call.run_in_thread)
+
+    return call
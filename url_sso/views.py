@@ -17,4 +17,93 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# Create your views here.
+""" Views for django-url-sso. """
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hashlib
+import json
+
+from django.contrib.auth.decorators import login_required
+from django.http import (
+    Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+)
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.cache import never_cache
+
+from .settings import url_sso_settings
+from .exceptions import RequestKeyException
+from .metrics import timed, increment, get_plugin_tag
+from .context_processors import LazyLoginURLs
+
+
+@never_cache
+@login_required
+def login_redirect(request, plugin_name, name):
+    """
+    Redirect to the login URL for a single site or service of a plugin,
+    requesting (or reusing) its key only once the link is followed.
+
+    Responds with 404 when the plugin, site or service is unknown or the
+    user has no access, and with 502 when no key could be obtained.
+    """
+
+    sso_plugin = url_sso_settings.get_plugin(plugin_name)
+
+    if sso_plugin is None:
+        raise Http404
+
+    plugin_tag = get_plugin_tag(sso_plugin)
+
+    with timed('login_urls', plugin=plugin_tag):
+        try:
+            login_url = sso_plugin.get_login_url(request, name)
+        except RequestKeyException:
+            logger.exception(
+                'Error requesting login key for %s %s', plugin_name, name
+            )
+
+            increment('login_urls.errors', plugin=plugin_tag)
+
+            return HttpResponse(
+                'Login key could not be obtained.', status=502,
+                content_type='text/plain'
+            )
+
+    if login_url is None:
+        raise Http404
+
+    return HttpResponseRedirect(login_url)
+
+
+def login_urls_json(request):
+    """
+    Return the login URL's of all plugins for the current user as a JSON
+    object, such that pages can load them after rendering.
+
+    Responses may be cached privately for URL_SSO_JSON_MAX_AGE seconds and
+    carry an ETag derived from the URL's, answering conditional requests
+    with 304 Not Modified.
+    """
+
+    login_urls = dict(LazyLoginURLs(request, url_sso_settings.PLUGINS))
+
+    content = json.dumps(login_urls, sort_keys=True)
+    etag = hashlib.md5(content).hexdigest()
+
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+
+    response['ETag'] = quote_etag(etag)
+
+    # URL's are specific to the user
+    patch_cache_control(
+        response, private=True, max_age=url_sso_settings.JSON_MAX_AGE
+    )
+    patch_vary_headers(response, ['Cookie'])
+
+    return response